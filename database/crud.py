@@ -1,38 +1,68 @@
-from typing import Optional
+import functools
+from typing import Any, Dict, List
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
 from sqlalchemy import text
+from sqlalchemy.sql.elements import TextClause
 
-from database.models import GiftCode
+# ---------------------------------------------------------------------------
+# Zapytania budowane raz (cache per kształt zapytania)
+# ---------------------------------------------------------------------------
 
 
-def assign_unused_gift_code(db: Session, value: int, order_id: str) -> Optional[GiftCode]:
+@functools.lru_cache(maxsize=16)
+def _sql_assign_bulk(values_count: int) -> TextClause:
     """
-    Pobiera pierwszy nieużyty kod o zadanym nominale i przypisuje mu order_id.
-    Zwraca obiekt GiftCode lub None.
+    Zapytanie dla assign_unused_gift_codes_bulk – zależy tylko od liczby
+    nominałów, więc budujemy je raz na każdą liczbę.
     """
-    row = db.execute(
-        text(
-            """
-            SELECT id
-            FROM gift_codes
-            WHERE value = :value AND order_id IS NULL
-            ORDER BY id ASC
-            LIMIT 1
-            """
+    req_rows = ", ".join(
+        f"(CAST(:v{i} AS INTEGER), CAST(:n{i} AS INTEGER))" for i in range(values_count)
+    )
+    # LATERAL + LIMIT req.n: osobny, zablokowany wybór puli dla każdego nominału
+    return text(
+        f"""
+        WITH req(value, n) AS (
+            VALUES {req_rows}
         ),
-        {"value": value},
-    ).fetchone()
+        picked AS (
+            SELECT g.id
+            FROM req
+            CROSS JOIN LATERAL (
+                SELECT id
+                FROM gift_codes
+                WHERE value = req.value AND order_id IS NULL
+                ORDER BY id ASC
+                LIMIT req.n
+                FOR UPDATE SKIP LOCKED
+            ) g
+        )
+        UPDATE gift_codes
+        SET order_id = :order_id
+        FROM picked
+        WHERE gift_codes.id = picked.id
+        RETURNING gift_codes.id, gift_codes.code, gift_codes.value
+        """
+    )
+
 
-    if not row:
-        return None
+def assign_unused_gift_codes_bulk(db: Session, order_id: str, wanted: Dict[int, int]) -> List[Row]:
+    """
+    Przypisuje kody dla wielu nominałów naraz ({nominał: ile_kodów}) jednym
+    zapytaniem – niezależnie od liczby różnych nominałów w zamówieniu.
+    Zwraca wiersze (id, code, value) posortowane po id; braki w puli
+    (mniej wierszy danego nominału niż chciano) sprawdza wywołujący.
+    Commit robi wywołujący.
+    """
+    wanted = {value: n for value, n in wanted.items() if n > 0}
+    if not wanted:
+        return []
 
-    gift_id = row.id
+    params: Dict[str, Any] = {"order_id": order_id}
+    for i, (value, n) in enumerate(wanted.items()):
+        params[f"v{i}"] = value
+        params[f"n{i}"] = n
 
-    db.execute(
-        text("UPDATE gift_codes SET order_id = :order_id WHERE id = :id"),
-        {"order_id": order_id, "id": gift_id},
-    )
+    rows = db.execute(_sql_assign_bulk(len(wanted)), params).fetchall()
 
-    # zwracamy obiekt ORM dla wygody (do odczytu code/value)
-    gc = db.get(GiftCode, gift_id)
-    return gc
+    return sorted(rows, key=lambda r: r.id)
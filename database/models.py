@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index
 from sqlalchemy.sql import func
 
 from database.session import Base
@@ -14,6 +14,32 @@ class GiftCode(Base):
     order_id = Column(String, nullable=True, index=True)
 
 
+# Częściowy indeks pod przydział kodów (WHERE value = :v AND order_id IS NULL ORDER BY id):
+# obejmuje tylko wolne kody, więc maleje w miarę zużywania puli.
+GIFT_CODES_UNUSED_INDEX = Index(
+    "ix_gift_codes_unused",
+    GiftCode.value,
+    GiftCode.id,
+    postgresql_where=GiftCode.order_id.is_(None),
+)
+
+# Indeks pokrywający dla statystyk w panelu (GROUP BY value + FILTER po order_id) –
+# pozwala policzyć wszystko z samego indeksu (index-only scan) zamiast z tabeli.
+GIFT_CODES_VALUE_ORDER_INDEX = Index(
+    "ix_gift_codes_value_order",
+    GiftCode.value,
+    GiftCode.order_id,
+)
+
+# Indeks pod listę kodów w panelu (WHERE value = :v ORDER BY id DESC LIMIT n) –
+# stronicowanie kursorem (id < :before_id) schodzi po nim prosto do kolejnej strony.
+GIFT_CODES_VALUE_ID_INDEX = Index(
+    "ix_gift_codes_value_id",
+    GiftCode.value,
+    GiftCode.id.desc(),
+)
+
+
 class WebhookEvent(Base):
     """
     Proste logi webhooków, do podglądu w panelu admina.
@@ -36,3 +62,12 @@ class WebhookEvent(Base):
         nullable=False,
         index=True,
     )
+
+
+# Indeks pod listę logów w panelu (ORDER BY created_at DESC, id DESC LIMIT n) –
+# skan wstecz daje od razu właściwą kolejność, bez sortowania całej tabeli.
+WEBHOOK_EVENTS_CREATED_ID_INDEX = Index(
+    "ix_webhook_events_created_id",
+    WebhookEvent.created_at,
+    WebhookEvent.id,
+)
@@ -1,9 +1,14 @@
 # database/session.py
 
+import logging
 import os
+import time
+from typing import Iterator
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+
+logger = logging.getLogger("giftcard-webhook")
 
 # ---------------------------------------------------------------------------
 # Konfiguracja połączenia z bazą
@@ -15,10 +20,25 @@ if not DATABASE_URL:
     # Lepiej wywalić się głośno przy starcie niż działać "po cichu" bez DB
     raise RuntimeError("ENV DATABASE_URL is not set")
 
+# Parametry puli połączeń (nadpisywalne z ENV)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE") or 20)
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW") or 10)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE") or 3600)
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT") or 30)
+# Ile połączeń otwieramy od razu przy starcie workera – mało, bo przy kilku workerach
+# (i nakładających się deployach) pełna pula każdego mogłaby wyczerpać max_connections
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP") or 2)
+
 # pre_ping = True – żeby szybciej wykrywać zerwane połączenia
+# pool_recycle – odnawiamy połączenia, zanim zerwie je serwer / proxy po bezczynności
+# pool_timeout – ile sekund request czeka na wolne połączenie, zanim dostanie błąd
 engine = create_engine(
     DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
     pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_timeout=DB_POOL_TIMEOUT,
 )
 
 # Klasyczna SessionLocal używana w całej aplikacji
@@ -28,6 +48,38 @@ SessionLocal = sessionmaker(
     bind=engine,
 )
 
+
+def get_db() -> Iterator[Session]:
+    """
+    Zależność FastAPI (Depends) – jedna sesja na request, zamykana po odpowiedzi.
+    Jedno miejsce na pomiar: czas życia sesji trafia do logu (DEBUG).
+    Handlery tylko-do-odczytu mogą oddać połączenie wcześniej (db.close() po
+    pobraniu wierszy) – ponowne close() tutaj jest wtedy no-opem.
+    """
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+        logger.debug("Sesja DB zamknięta po %.1f ms", (time.perf_counter() - started) * 1000)
+
+
+def warm_up_pool(size: int) -> None:
+    """
+    Otwiera naraz `size` połączeń i oddaje je do puli, żeby pierwsze requesty
+    po starcie nie płaciły za zestawianie połączeń z bazą.
+    """
+    connections = []
+    try:
+        for _ in range(size):
+            conn = engine.connect()
+            connections.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in connections:
+            conn.close()
+
 # ---------------------------------------------------------------------------
 # Wspólna baza dla modeli (declarative base)
 # ---------------------------------------------------------------------------
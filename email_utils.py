@@ -1,12 +1,17 @@
 import os
+import asyncio
 import logging
 import base64
 import time
-from typing import List, Tuple, Dict, Any, Optional
+from typing import Iterable, Iterator, List, Sequence, Tuple, Dict, Any, Optional, Union
 
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from pdf_utils import generate_giftcard_pdf
+from pdf_utils import generate_giftcard_pdfs
 
 logger = logging.getLogger("giftcard-webhook")
 
@@ -31,6 +36,45 @@ BREVO_REPLY_TO: str = (os.getenv("BREVO_REPLY_TO") or "").strip() or BREVO_FROM_
 
 BREVO_API_URL = "https://api.brevo.com/v3/smtp/email"
 
+# Wspólna sesja HTTP dla Brevo – połączenie TLS jest utrzymywane (keep-alive)
+# i reużywane między kolejnymi mailami zamiast zestawiania go przy każdej wysyłce.
+# Retry tylko dla błędów połączenia i 429 – przy 5xx mail mógł już wyjść.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=10,
+        max_retries=Retry(
+            total=3,
+            connect=3,
+            read=0,
+            status=3,
+            backoff_factor=0.3,
+            status_forcelist=(429,),
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        ),
+    ),
+)
+_SESSION.headers.update(
+    {
+        "accept": "application/json",
+        "content-type": "application/json",
+    }
+)
+
+# Asynchroniczny odpowiednik _SESSION dla webhooka (async) – jeden klient na proces,
+# retries=3 dotyczy tylko błędów nawiązania połączenia.
+_ASYNC_CLIENT = httpx.AsyncClient(
+    headers={
+        "accept": "application/json",
+        "content-type": "application/json",
+    },
+    timeout=15,
+    transport=httpx.AsyncHTTPTransport(retries=3, http2=True),
+)
+
 logger.info("Brevo FROM email skonfigurowany jako: %r", BREVO_FROM_EMAIL)
 logger.info("Brevo FROM name skonfigurowany jako: %r", BREVO_FROM_NAME)
 logger.info("Brevo REPLY-TO skonfigurowany jako: %r", BREVO_REPLY_TO)
@@ -41,26 +85,37 @@ logger.info("Brevo REPLY-TO skonfigurowany jako: %r", BREVO_REPLY_TO)
 # ------------------------------------------------------------------------------
 
 
-def send_email(
-    to_email: str,
+def _build_attachments(attachments: Iterable[Tuple[str, bytes]]) -> Iterator[Dict[str, Any]]:
+    """
+    Koduje załączniki do formatu Brevo (nazwa + treść w base64).
+    """
+    for filename, file_bytes in attachments:
+        yield {
+            "name": filename,
+            "content": base64.b64encode(file_bytes).decode("ascii"),
+        }
+
+
+def _build_payload(
+    to_email: Union[str, Sequence[str]],
     subject: str,
     body_text: str,
-    body_html: Optional[str] = None,
-    attachments: Optional[List[Tuple[str, bytes]]] = None,
-) -> None:
+    body_html: Optional[str],
+    attachments: Optional[Iterable[Tuple[str, bytes]]],
+) -> Tuple[bytes, str]:
     """
-    Wysyła wiadomość e-mail przy użyciu Brevo Transactional Email API v3.
-
-    :param to_email: adres odbiorcy
-    :param subject: temat wiadomości
-    :param body_text: treść w formacie text/plain
-    :param body_html: treść w formacie text/html (opcjonalnie)
-    :param attachments: lista załączników (nazwa_pliku, zawartość_bytes)
+    Buduje ciało zapytania do Brevo (JSON jako bytes) oraz etykietę odbiorców do logów.
+    Wspólne dla send_email i send_email_async.
     """
     if not BREVO_API_KEY:
         logger.error("Brak BREVO_API_KEY – nie można wysłać e-maila.")
         raise RuntimeError("BREVO_API_KEY is not configured")
 
+    recipients = [to_email] if isinstance(to_email, str) else list(to_email)
+    if not recipients:
+        raise ValueError("Brak adresu odbiorcy")
+    recipients_label = ", ".join(recipients)
+
     if body_html is None:
         body_html = f"<pre>{body_text}</pre>"
 
@@ -69,44 +124,98 @@ def send_email(
             "email": BREVO_FROM_EMAIL,
             "name": BREVO_FROM_NAME,
         },
-        "to": [{"email": to_email}],
         "subject": subject,
         "textContent": body_text,
         "htmlContent": body_html,
         "replyTo": {"email": BREVO_REPLY_TO},
     }
 
+    if len(recipients) == 1:
+        payload["to"] = [{"email": recipients[0]}]
+    else:
+        # messageVersions: osobna wiadomość dla każdego adresu w jednym wywołaniu API –
+        # odbiorcy nie widzą nawzajem swoich adresów (jak przy wspólnym "to")
+        payload["messageVersions"] = [{"to": [{"email": email}]} for email in recipients]
+
     # Załączniki w Brevo: tablica "attachment", elementy mają m.in.:
     # - name: nazwa pliku
     # - content: base64
     # (alternatywnie można podać url, ale tu generujesz PDF w runtime)
-    if attachments:
-        brevo_attachments: List[Dict[str, Any]] = []
-        for filename, file_bytes in attachments:
-            encoded = base64.b64encode(file_bytes).decode("ascii")
-            brevo_attachments.append(
-                {
-                    "name": filename,
-                    "content": encoded,
-                }
-            )
-        payload["attachment"] = brevo_attachments
-
-    headers = {
-        "accept": "application/json",
-        "api-key": BREVO_API_KEY,
-        "content-type": "application/json",
-    }
+    if attachments is not None:
+        brevo_attachments = list(_build_attachments(attachments))
+        if brevo_attachments:
+            payload["attachment"] = brevo_attachments
+
+    return orjson.dumps(payload), recipients_label
 
-    logger.info("Wysyłanie e-maila do %s przez Brevo...", to_email)
-    resp = requests.post(BREVO_API_URL, json=payload, headers=headers, timeout=15)
 
+def _check_response(status_code: int, text: str, recipients_label: str) -> None:
     # Brevo zwykle zwraca 201 Created dla poprawnej wysyłki
-    if resp.status_code not in (200, 201, 202):
-        logger.error("Błąd Brevo: %s – %s", resp.status_code, resp.text)
-        raise RuntimeError(f"Brevo send failed: HTTP {resp.status_code} – {resp.text}")
+    if status_code not in (200, 201, 202):
+        logger.error("Błąd Brevo: %s – %s", status_code, text)
+        raise RuntimeError(f"Brevo send failed: HTTP {status_code} – {text}")
+
+    logger.info("E-mail do %s został pomyślnie wysłany (HTTP %s).", recipients_label, status_code)
+
+
+def send_email(
+    to_email: Union[str, Sequence[str]],
+    subject: str,
+    body_text: str,
+    body_html: Optional[str] = None,
+    attachments: Optional[Iterable[Tuple[str, bytes]]] = None,
+) -> None:
+    """
+    Wysyła wiadomość e-mail przy użyciu Brevo Transactional Email API v3.
+
+    :param to_email: adres odbiorcy albo lista adresów – wtedy jedno wywołanie API
+                     (jedno połączenie), a każdy adres dostaje osobną wiadomość
+                     (messageVersions), bez podglądu pozostałych odbiorców
+    :param subject: temat wiadomości
+    :param body_text: treść w formacie text/plain
+    :param body_html: treść w formacie text/html (opcjonalnie)
+    :param attachments: załączniki (nazwa_pliku, zawartość_bytes) – lista lub generator
+    """
+    body, recipients_label = _build_payload(to_email, subject, body_text, body_html, attachments)
+
+    logger.info("Wysyłanie e-maila do %s przez Brevo...", recipients_label)
+    resp = _SESSION.post(
+        BREVO_API_URL,
+        data=body,
+        headers={"api-key": BREVO_API_KEY},
+        timeout=15,
+    )
+
+    _check_response(resp.status_code, resp.text, recipients_label)
+
+
+async def send_email_async(
+    to_email: Union[str, Sequence[str]],
+    subject: str,
+    body_text: str,
+    body_html: Optional[str] = None,
+    attachments: Optional[Iterable[Tuple[str, bytes]]] = None,
+) -> None:
+    """
+    Jak send_email, ale przez współdzielony httpx.AsyncClient – nie blokuje pętli zdarzeń.
+    """
+    body, recipients_label = _build_payload(to_email, subject, body_text, body_html, attachments)
+
+    logger.info("Wysyłanie e-maila do %s przez Brevo (async)...", recipients_label)
+    resp = await _ASYNC_CLIENT.post(
+        BREVO_API_URL,
+        content=body,
+        headers={"api-key": BREVO_API_KEY},
+    )
+
+    _check_response(resp.status_code, resp.text, recipients_label)
 
-    logger.info("E-mail do %s został pomyślnie wysłany (HTTP %s).", to_email, resp.status_code)
+
+async def close_async_client() -> None:
+    """
+    Zamyka połączenia asynchronicznego klienta Brevo (przy zamykaniu aplikacji).
+    """
+    await _ASYNC_CLIENT.aclose()
 
 
 # ------------------------------------------------------------------------------
@@ -199,22 +308,18 @@ def build_giftcard_html(order_serial_number: str) -> str:
 # ------------------------------------------------------------------------------
 
 
-def send_giftcard_email(
-    to_email: str,
+# Opóźnienie wysyłki maila z kartą względem przydzielenia kodów
+GIFTCARD_EMAIL_DELAY_SECONDS = 3 * 60
+
+
+def _build_giftcard_message(
     codes: List[Dict[str, Any]],
     order_serial_number: str,
-) -> None:
+) -> Tuple[str, str, str, List[Tuple[str, Any]]]:
     """
-    Wysyła maila z kartami podarunkowymi.
+    Buduje temat, treść text/plain i HTML maila z kartami oraz listę (code, value)
+    do wygenerowania PDF-ów.
     """
-    delay_seconds = 3 * 60
-    logger.info(
-        "Zaplanowano wysyłkę e-maila z kartą/kartami do %s za %s sekund.",
-        to_email,
-        delay_seconds,
-    )
-    time.sleep(delay_seconds)
-
     subject = f"Twoja karta podarunkowa – zamówienie {order_serial_number}"
 
     lines: List[str] = [
@@ -226,17 +331,14 @@ def send_giftcard_email(
         "Podsumowanie kart:",
     ]
 
-    attachments: List[Tuple[str, bytes]] = []
+    cards: List[Tuple[str, Any]] = []
 
     for c in codes:
         code = str(c.get("code"))
         value = c.get("value")
 
         lines.append(f"- {value} zł – kod: {code}")
-
-        pdf_bytes = generate_giftcard_pdf(code=code, value=value)
-        filename = f"WASSYL-GIFTCARD-{value}zl-{code}.pdf"
-        attachments.append((filename, pdf_bytes))
+        cards.append((code, value))
 
     lines.extend(
         [
@@ -255,10 +357,69 @@ def send_giftcard_email(
     body_text = "\n".join(lines)
     body_html = _build_giftcard_html(order_serial_number)
 
+    return subject, body_text, body_html, cards
+
+
+def _giftcard_attachments(
+    cards: List[Tuple[str, Any]],
+    pdfs: List[bytes],
+) -> Iterator[Tuple[str, bytes]]:
+    for (code, value), pdf in zip(cards, pdfs):
+        yield f"WASSYL-GIFTCARD-{value}zl-{code}.pdf", pdf
+
+
+def send_giftcard_email(
+    to_email: str,
+    codes: List[Dict[str, Any]],
+    order_serial_number: str,
+) -> None:
+    """
+    Wysyła maila z kartami podarunkowymi.
+    """
+    delay_seconds = GIFTCARD_EMAIL_DELAY_SECONDS
+    logger.info(
+        "Zaplanowano wysyłkę e-maila z kartą/kartami do %s za %s sekund.",
+        to_email,
+        delay_seconds,
+    )
+    time.sleep(delay_seconds)
+
+    subject, body_text, body_html, cards = _build_giftcard_message(codes, order_serial_number)
+    pdfs = generate_giftcard_pdfs(cards)
+
     send_email(
         to_email=to_email,
         subject=subject,
         body_text=body_text,
         body_html=body_html,
-        attachments=attachments,
+        attachments=_giftcard_attachments(cards, pdfs),
+    )
+
+
+async def send_giftcard_email_async(
+    to_email: str,
+    codes: List[Dict[str, Any]],
+    order_serial_number: str,
+) -> None:
+    """
+    Wersja send_giftcard_email dla kodu async: opóźnienie to asyncio.sleep (nie trzyma
+    wątku), PDF-y renderowane poza pętlą zdarzeń, wysyłka przez httpx.AsyncClient.
+    """
+    delay_seconds = GIFTCARD_EMAIL_DELAY_SECONDS
+    logger.info(
+        "Zaplanowano wysyłkę e-maila z kartą/kartami do %s za %s sekund.",
+        to_email,
+        delay_seconds,
+    )
+    await asyncio.sleep(delay_seconds)
+
+    subject, body_text, body_html, cards = _build_giftcard_message(codes, order_serial_number)
+    pdfs = await asyncio.to_thread(generate_giftcard_pdfs, cards)
+
+    await send_email_async(
+        to_email=to_email,
+        subject=subject,
+        body_text=body_text,
+        body_html=body_html,
+        attachments=_giftcard_attachments(cards, pdfs),
     )
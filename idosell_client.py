@@ -1,8 +1,10 @@
+import asyncio
 import logging
 import time
 from typing import Any
 
-import requests
+import httpx
+import orjson
 
 logger = logging.getLogger("giftcard-webhook")
 
@@ -17,6 +19,11 @@ class IdosellClient:
     notatki do zamówienia (orderNote) po numerze seryjnym zamówienia.
     """
 
+    # 1. próba od razu
+    # kolejne retry po: 2 s, 5 s, 15 s, 60 s
+    RETRY_DELAYS = (2, 5, 15, 60)
+    MAX_ATTEMPTS = 1 + len(RETRY_DELAYS)
+
     def __init__(self, domain: str, api_key: str, timeout: float = 10.0) -> None:
         """
         :param domain: np. "client5056.idosell.com" (może być też z https:// – zostanie obcięte)
@@ -28,18 +35,46 @@ class IdosellClient:
         self.base_url = f"https://{domain.strip('/')}/api/admin/v6/orders/orders"
         self.timeout = timeout
 
-        self.session = requests.Session()
-        self.session.headers.update(
-            {
+        # Jeden klient na cały proces – połączenie TCP/TLS jest utrzymywane
+        # (keep-alive) i współdzielone między kolejnymi wywołaniami API.
+        self._client = httpx.Client(
+            headers={
                 "accept": "application/json",
                 "content-type": "application/json",
                 "X-API-KEY": api_key,
-            }
+            },
+            timeout=timeout,
+            # HTTP/2: kolejne zapytania multipleksowane po jednym połączeniu;
+            # keepalive_expiry dłuższe niż domyślne 5 s, żeby nie zrywać połączenia między webhookami
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30),
+        )
+
+        # Odpowiednik dla webhooka (async) – te same nagłówki i limity, osobna pula połączeń
+        self._async_client = httpx.AsyncClient(
+            headers=self._client.headers,
+            timeout=timeout,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=50, max_keepalive_connections=20, keepalive_expiry=30
+            ),
         )
 
         logger.info("IdosellClient zainicjalizowany dla domeny %s", domain)
 
-    def _parse_json_safely(self, resp: requests.Response) -> Any:
+    def close(self) -> None:
+        """
+        Zamyka połączenia HTTP klienta (wywoływane przy zamykaniu aplikacji).
+        """
+        self._client.close()
+
+    async def aclose(self) -> None:
+        """
+        Zamyka połączenia klienta asynchronicznego (wywoływane przy zamykaniu aplikacji).
+        """
+        await self._async_client.aclose()
+
+    def _parse_json_safely(self, resp: httpx.Response) -> Any:
         """
         Pomocniczo: próba sparsowania JSON-a; w razie problemów zwracamy None.
         """
@@ -48,18 +83,7 @@ class IdosellClient:
         except ValueError:
             return None
 
-    def update_order_note(self, order_serial_number: int | str, note: str) -> None:
-        """
-        Ustawia notatkę do zamówienia (orderNote) dla danego zamówienia.
-
-        Retry działa dla błędów transportowych / sieciowych, np.:
-        - Connection reset by peer
-        - timeout
-        - chwilowy problem z połączeniem
-
-        Nie retryujemy błędów logicznych API (HTTP 4xx/5xx zwrócone przez API
-        lub struktury errors w odpowiedzi JSON).
-        """
+    def _note_payload(self, order_serial_number: int | str, note: str) -> bytes:
         try:
             serial_value: int | str = int(order_serial_number)
         except (TypeError, ValueError):
@@ -75,96 +99,128 @@ class IdosellClient:
                 ]
             }
         }
+        return orjson.dumps(payload)
 
-        # 1. próba od razu
-        # kolejne retry po: 2 s, 5 s, 15 s, 60 s
-        retry_delays = [2, 5, 15, 60]
-        max_attempts = 1 + len(retry_delays)
+    def _check_note_response(self, resp: httpx.Response, order_serial_number: int | str) -> None:
+        """
+        Rzuca IdosellApiError, jeśli API zwróciło błąd HTTP lub strukturę errors.
+        """
+        if resp.status_code >= 400:
+            logger.error(
+                "Idosell API zwrócił błąd HTTP %s dla orderSerialNumber=%s: %s",
+                resp.status_code,
+                order_serial_number,
+                resp.text,
+            )
+            raise IdosellApiError(
+                f"HTTP {resp.status_code} podczas aktualizacji notatki: {resp.text}"
+            )
+
+        data = self._parse_json_safely(resp)
+
+        if isinstance(data, dict) and data.get("errors"):
+            logger.error(
+                "Idosell API zwrócił błąd logiczny (dict) dla orderSerialNumber=%s: %s",
+                order_serial_number,
+                data["errors"],
+            )
+            raise IdosellApiError(f"API error: {data['errors']}")
+
+        if isinstance(data, list):
+            for item in data:
+                if isinstance(item, dict) and item.get("errors"):
+                    logger.error(
+                        "Idosell API zwrócił błąd logiczny (list) dla "
+                        "orderSerialNumber=%s: %s",
+                        order_serial_number,
+                        item["errors"],
+                    )
+                    raise IdosellApiError(f"API error: {item['errors']}")
 
-        last_exc: Exception | None = None
+        logger.info(
+            "Pomyślnie zaktualizowano notatkę zamówienia %s w Idosell.",
+            order_serial_number,
+        )
 
-        for attempt in range(1, max_attempts + 1):
-            try:
-                logger.info(
-                    "Aktualizuję notatkę zamówienia w Idosell: "
-                    "orderSerialNumber=%s, próba=%s/%s, url=%s",
-                    order_serial_number,
-                    attempt,
-                    max_attempts,
-                    self.base_url,
-                )
+    def _retry_delay(
+        self, order_serial_number: int | str, attempt: int, e: httpx.TransportError
+    ) -> float:
+        """
+        Zwraca opóźnienie przed kolejną próbą albo rzuca ostatni błąd, gdy prób już brak.
+        """
+        if attempt >= self.MAX_ATTEMPTS:
+            logger.error(
+                "Nie udało się zaktualizować notatki zamówienia %s po %s próbach. "
+                "Ostatni błąd: %s",
+                order_serial_number,
+                attempt,
+                e,
+            )
+            raise e
+
+        delay = self.RETRY_DELAYS[attempt - 1]
+        logger.warning(
+            "Błąd połączenia przy aktualizacji notatki zamówienia %s "
+            "(próba %s/%s): %s. Ponawiam za %s s.",
+            order_serial_number,
+            attempt,
+            self.MAX_ATTEMPTS,
+            e,
+            delay,
+        )
+        return delay
+
+    def _log_attempt(self, order_serial_number: int | str, attempt: int) -> None:
+        logger.info(
+            "Aktualizuję notatkę zamówienia w Idosell: "
+            "orderSerialNumber=%s, próba=%s/%s, url=%s",
+            order_serial_number,
+            attempt,
+            self.MAX_ATTEMPTS,
+            self.base_url,
+        )
 
-                resp = self.session.put(
-                    self.base_url,
-                    json=payload,
-                    timeout=self.timeout,
-                )
+    def update_order_note(self, order_serial_number: int | str, note: str) -> None:
+        """
+        Ustawia notatkę do zamówienia (orderNote) dla danego zamówienia.
 
-                if resp.status_code >= 400:
-                    logger.error(
-                        "Idosell API zwrócił błąd HTTP %s dla orderSerialNumber=%s: %s",
-                        resp.status_code,
-                        order_serial_number,
-                        resp.text,
-                    )
-                    raise IdosellApiError(
-                        f"HTTP {resp.status_code} podczas aktualizacji notatki: {resp.text}"
-                    )
+        Retry działa dla błędów transportowych / sieciowych, np.:
+        - Connection reset by peer
+        - timeout
+        - chwilowy problem z połączeniem
 
-                data = self._parse_json_safely(resp)
+        Nie retryujemy błędów logicznych API (HTTP 4xx/5xx zwrócone przez API
+        lub struktury errors w odpowiedzi JSON).
+        """
+        body = self._note_payload(order_serial_number, note)
 
-                if isinstance(data, dict) and data.get("errors"):
-                    logger.error(
-                        "Idosell API zwrócił błąd logiczny (dict) dla orderSerialNumber=%s: %s",
-                        order_serial_number,
-                        data["errors"],
-                    )
-                    raise IdosellApiError(f"API error: {data['errors']}")
-
-                if isinstance(data, list):
-                    for item in data:
-                        if isinstance(item, dict) and item.get("errors"):
-                            logger.error(
-                                "Idosell API zwrócił błąd logiczny (list) dla "
-                                "orderSerialNumber=%s: %s",
-                                order_serial_number,
-                                item["errors"],
-                            )
-                            raise IdosellApiError(f"API error: {item['errors']}")
-
-                logger.info(
-                    "Pomyślnie zaktualizowano notatkę zamówienia %s w Idosell.",
-                    order_serial_number,
-                )
-                return
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            self._log_attempt(order_serial_number, attempt)
+            try:
+                resp = self._client.put(self.base_url, content=body, timeout=self.timeout)
+            except httpx.TransportError as e:
+                time.sleep(self._retry_delay(order_serial_number, attempt, e))
+                continue
 
-            except IdosellApiError:
-                raise
+            self._check_note_response(resp, order_serial_number)
+            return
 
-            except (requests.ConnectionError, requests.Timeout, requests.RequestException) as e:
-                last_exc = e
+    async def update_order_note_async(self, order_serial_number: int | str, note: str) -> None:
+        """
+        Jak update_order_note, ale przez httpx.AsyncClient – nie zajmuje wątku
+        na czas zapytania ani przerw między ponowieniami (asyncio.sleep).
+        """
+        body = self._note_payload(order_serial_number, note)
 
-                if attempt >= max_attempts:
-                    logger.error(
-                        "Nie udało się zaktualizować notatki zamówienia %s po %s próbach. "
-                        "Ostatni błąd: %s",
-                        order_serial_number,
-                        attempt,
-                        e,
-                    )
-                    raise
-
-                delay = retry_delays[attempt - 1]
-                logger.warning(
-                    "Błąd połączenia przy aktualizacji notatki zamówienia %s "
-                    "(próba %s/%s): %s. Ponawiam za %s s.",
-                    order_serial_number,
-                    attempt,
-                    max_attempts,
-                    e,
-                    delay,
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            self._log_attempt(order_serial_number, attempt)
+            try:
+                resp = await self._async_client.put(
+                    self.base_url, content=body, timeout=self.timeout
                 )
-                time.sleep(delay)
+            except httpx.TransportError as e:
+                await asyncio.sleep(self._retry_delay(order_serial_number, attempt, e))
+                continue
 
-        if last_exc:
-            raise last_exc
+            self._check_note_response(resp, order_serial_number)
+            return
@@ -1,31 +1,62 @@
+import asyncio
+import functools
 import logging
 import os
-import json
 import io
 import zipfile
 import csv
-from typing import List, Dict, Any, Optional
-
-from fastapi import FastAPI, Request, Query, HTTPException
+import gzip
+import hashlib
+import queue
+import re
+import threading
+import time
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+import anyio.to_thread
+import orjson
+from fastapi import FastAPI, Request, Query, HTTPException, Depends, BackgroundTasks
 from fastapi.responses import (
     Response,
     HTMLResponse,
-    JSONResponse,
+    ORJSONResponse,
     PlainTextResponse,
+    StreamingResponse,
 )
-from sqlalchemy import text
+from sqlalchemy import bindparam, inspect, text
 from sqlalchemy.exc import SQLAlchemyError
-
-from database.models import Base
-from database.session import engine, SessionLocal
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import TextClause
+
+from database.models import (
+    Base,
+    GIFT_CODES_UNUSED_INDEX,
+    GIFT_CODES_VALUE_ID_INDEX,
+    GIFT_CODES_VALUE_ORDER_INDEX,
+    WEBHOOK_EVENTS_CREATED_ID_INDEX,
+    WebhookEvent,
+)
+from database.session import DB_POOL_WARMUP, engine, SessionLocal, get_db, warm_up_pool
 from database import crud
-from pdf_utils import generate_giftcard_pdf, TEMPLATE_PATH
-from email_utils import send_giftcard_email, send_email
+from pdf_utils import (
+    generate_giftcard_pdf,
+    generate_giftcard_pdfs,
+    shutdown_pdf_pool,
+    TEMPLATE_PATH,
+)
+from email_utils import (
+    close_async_client,
+    send_email,
+    send_email_async,
+    send_giftcard_email_async,
+)
 from idosell_client import IdosellClient, IdosellApiError
 from fastapi import Request
 from fastapi.responses import HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 
 # ------------------------------------------------------------------------------
 # Konfiguracja aplikacji i logowania
@@ -34,10 +65,43 @@ from fastapi.templating import Jinja2Templates
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("giftcard-webhook")
 
-app = FastAPI(title="WASSYL Giftcard Webhook")
+# Gzip tylko tam, gdzie się opłaca: API panelu (JSON, eksport CSV) i admin.js/css.
+# Pomijamy PDF/ZIP (już skompresowane – sam koszt CPU przy największych odpowiedziach)
+# oraz /admin, które samo wysyła gotowy gzip.
+_GZIP_PATH_PREFIXES = ("/admin/api/", "/static/")
+_GZIP_SKIP_PATHS = frozenset({"/admin/api/manual/pdf"})
+
+
+class _AdminGZipMiddleware:
+    """
+    GZipMiddleware uruchamiany tylko dla ścieżek z _GZIP_PATH_PREFIXES.
+    """
+
+    def __init__(self, app, **gzip_options) -> None:
+        self.app = app
+        self.gzip_app = GZipMiddleware(app, **gzip_options)
+
+    async def __call__(self, scope, receive, send) -> None:
+        path = scope.get("path", "")
+        if (
+            scope["type"] == "http"
+            and path.startswith(_GZIP_PATH_PREFIXES)
+            and path not in _GZIP_SKIP_PATHS
+        ):
+            await self.gzip_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
 
-# Inicjalizacja bazy (w tym nowej tabeli webhook_events)
-Base.metadata.create_all(bind=engine)
+
+app = FastAPI(title="WASSYL Giftcard Webhook", default_response_class=ORJSONResponse)
+# Poziom 5: JSON/CSV kurczy się prawie tak samo jak przy 9, za ułamek CPU.
+app.add_middleware(_AdminGZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Tworzenie schematu przy starcie (patrz _init_db_schema); DB_CREATE_SCHEMA=0
+# wyłącza je, gdy schematem zarządzają migracje
+DB_CREATE_SCHEMA = (os.getenv("DB_CREATE_SCHEMA") or "1").strip() not in ("0", "false", "no")
+# Klucz advisory locka dla tworzenia schematu (dowolna stała, byle unikalna w bazie)
+_SCHEMA_LOCK_KEY = 0x6769667463617264
 
 # Globalny klient Idosell (może być None, jeśli brak konfiguracji)
 IDOSELL_DOMAIN = os.getenv("IDOSELL_DOMAIN")
@@ -55,6 +119,87 @@ else:
         "Brak konfiguracji IDOSELL_DOMAIN/IDOSELL_API_KEY – integracja z Idosell będzie nieaktywna."
     )
 
+
+# Synchroniczne endpointy (SQLAlchemy/psycopg2) i wszystko, co webhook woła przez
+# run_in_threadpool, dzielą jedną pulę wątków AnyIO (domyślnie 40). Wolne wywołania
+# (renderowanie PDF-ów, eksport, Idosell w ręcznym wydaniu) potrafią trzymać wątki,
+# więc domyślny limit łatwo wyczerpać i zablokować panel admina.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE") or 100)
+
+
+@app.on_event("startup")
+def _configure_threadpool() -> None:
+    """
+    Ustawia limit wątków dla endpointów synchronicznych i run_in_threadpool.
+    """
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+
+@app.on_event("startup")
+def _init_db_schema() -> None:
+    """
+    Inicjalizacja bazy (w tym tabeli webhook_events) – w starcie aplikacji, nie przy
+    imporcie modułu, więc sam import nie wymaga połączenia z bazą.
+    create_all tylko, gdy czegoś brakuje, żeby kolejne workery nie robiły pełnej
+    refleksji schematu.
+
+    Przy kilku workerach (uvicorn --workers) DDL robi jeden naraz – pozostałe czekają
+    na advisory lock i zastają już gotowy schemat.
+    """
+    if not DB_CREATE_SCHEMA:
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _SCHEMA_LOCK_KEY})
+            inspector = inspect(conn)
+            if not all(inspector.has_table(name) for name in Base.metadata.tables):
+                Base.metadata.create_all(bind=conn)
+            # create_all nie dokłada indeksów do już istniejących tabel
+            GIFT_CODES_UNUSED_INDEX.create(bind=conn, checkfirst=True)
+            GIFT_CODES_VALUE_ORDER_INDEX.create(bind=conn, checkfirst=True)
+            GIFT_CODES_VALUE_ID_INDEX.create(bind=conn, checkfirst=True)
+            WEBHOOK_EVENTS_CREATED_ID_INDEX.create(bind=conn, checkfirst=True)
+    except Exception as e:
+        logger.exception("Nie udało się zainicjalizować schematu bazy: %s", e)
+
+
+@app.on_event("startup")
+def _warm_up_db_pool() -> None:
+    """
+    Wstępnie zestawia połączenia z bazą, żeby pierwsze webhooki nie czekały na pulę.
+    """
+    try:
+        warm_up_pool(min(DB_POOL_WARMUP, engine.pool.size()))
+    except Exception as e:
+        logger.warning("Nie udało się rozgrzać puli połączeń DB: %s", e)
+
+
+@app.on_event("shutdown")
+async def _close_idosell_client() -> None:
+    """
+    Zamyka połączenia HTTP klienta Idosell przy zatrzymaniu aplikacji.
+    """
+    if idosell_client is not None:
+        idosell_client.close()
+        await idosell_client.aclose()
+
+
+@app.on_event("shutdown")
+async def _close_email_client() -> None:
+    """
+    Zamyka asynchronicznego klienta HTTP do Brevo.
+    """
+    await close_async_client()
+
+
+@app.on_event("shutdown")
+def _shutdown_pdf_pool() -> None:
+    """
+    Zamyka pulę procesów renderujących PDF-y kart.
+    """
+    shutdown_pdf_pool()
+
+
 # Stałe dla produktu karty podarunkowej
 GIFT_PRODUCT_ID = 14409
 GIFT_VARIANTS = {
@@ -63,10 +208,219 @@ GIFT_VARIANTS = {
     "300 zł": 300,
     "500 zł": 500,
 }
+_GIFT_VARIANT_ITEMS = tuple(GIFT_VARIANTS.items())
+_GIFT_VARIANT_VALUES = frozenset(GIFT_VARIANTS.values())
+# Pola pozycji koszyka, w których Idosell może trzymać nominał
+_GIFT_VARIANT_TEXT_KEYS = ("productName", "sizePanelName", "sizeName", "versionName")
+_NON_DIGITS_RE = re.compile(r"\D+")
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
+# ------------------------------------------------------------------------------
+# Zapytania SQL przygotowane raz, przy imporcie modułu
+# ------------------------------------------------------------------------------
+
+_SQL_SELECT_1 = text("SELECT 1")
+
+# Blokada per zamówienie na czas transakcji przydziału (patrz _assign_order_codes)
+_SQL_LOCK_ORDER = text("SELECT pg_advisory_xact_lock(hashtext(:order_id))")
+
+_SQL_ORDER_CODE_COUNTS = text(
+    """
+    SELECT value, COUNT(*) AS cnt
+    FROM gift_codes
+    WHERE order_id = :order_id
+    GROUP BY value
+    """
+)
+
+_SQL_CODE_STATS = text(
+    """
+    SELECT
+      value,
+      COUNT(*) AS total,
+      COUNT(*) FILTER (WHERE order_id IS NULL) AS unused,
+      COUNT(*) FILTER (WHERE order_id IS NOT NULL) AS used
+    FROM gift_codes
+    GROUP BY value
+    ORDER BY value
+    """
+)
+
+_SQL_INSERT_CODES = text(
+    """
+    INSERT INTO gift_codes (code, value, order_id)
+    SELECT c, :value, NULL
+    FROM unnest(CAST(:codes AS TEXT[])) AS c
+    ON CONFLICT (code) DO NOTHING
+    RETURNING id
+    """
+)
+
+# SQLAlchemy expanding param dla IN (...)
+_SQL_CODES_BY_CODE = text(
+    """
+    SELECT code, value, order_id
+    FROM gift_codes
+    WHERE code IN :codes
+    """
+).bindparams(bindparam("codes", expanding=True))
+
+_SQL_CORRECT_VALUE = text(
+    """
+    UPDATE gift_codes
+    SET value = :new_value
+    WHERE order_id IS NULL
+      AND code IN :codes
+    """
+).bindparams(bindparam("codes", expanding=True))
+
+# Ręczne wydanie: istniejący kod zamówienia albo przypisanie pierwszego wolnego –
+# jednym zapytaniem (UPDATE rusza tylko, gdy zamówienie nie ma jeszcze kodu)
+_SQL_ISSUE_ORDER_CODE = text(
+    """
+    WITH existing AS (
+        SELECT id, code, value, order_id
+        FROM gift_codes
+        WHERE order_id = :order_id
+        ORDER BY id ASC
+        LIMIT 1
+    ),
+    assigned AS (
+        UPDATE gift_codes
+        SET order_id = :order_id
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+          AND id = (
+            SELECT id
+            FROM gift_codes
+            WHERE value = :value AND order_id IS NULL
+            ORDER BY id ASC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+          )
+        RETURNING id, code, value, order_id
+    )
+    SELECT code, value, order_id, TRUE AS reused FROM existing
+    UNION ALL
+    SELECT code, value, order_id, FALSE AS reused FROM assigned
+    """
+)
+
+_SQL_ORDER_CODES = text(
+    """
+    SELECT code, value
+    FROM gift_codes
+    WHERE order_id = :order_id
+    ORDER BY id ASC
+    """
+)
+
+_SQL_LIST_LOGS = text(
+    """
+    SELECT id, event_type, status, message,
+           order_id, order_serial, created_at
+    FROM webhook_events
+    ORDER BY created_at DESC, id DESC
+    LIMIT :limit
+    """
+)
+
+# Mail z kartami z webhooka idzie w tle, kilka minut po odpowiedzi do Idosell –
+# znacznik "email_pending" zapisujemy w tej samej transakcji co przydział kodów,
+# a zadanie w tle zamienia go na email_sent / email_error. Restart w międzyczasie
+# zostawia w logach panelu widoczne "email_pending" zamiast cichej utraty maila.
+_SQL_INSERT_PENDING_EMAIL = text(
+    """
+    INSERT INTO webhook_events (event_type, status, message, order_id, order_serial)
+    VALUES ('giftcard_email', 'email_pending', :message, :order_id, :order_serial)
+    """
+)
+
+_SQL_RESOLVE_PENDING_EMAIL = text(
+    """
+    UPDATE webhook_events
+    SET status = :status, message = :message
+    WHERE event_type = 'giftcard_email'
+      AND status = 'email_pending'
+      AND order_serial = :order_serial
+    """
+)
+
+
+@functools.lru_cache(maxsize=16)
+def _sql_list_codes(
+    with_value: bool, used: Optional[str], keyset: bool
+) -> Tuple[TextClause, TextClause]:
+    """
+    (zapytanie COUNT, zapytanie strony) dla /admin/api/codes – zależą tylko od
+    kształtu filtra, więc budujemy je raz na każdą kombinację, a wartości idą
+    jako parametry (:value, :limit, :offset / :before_id).
+    """
+    conditions = []
+    if with_value:
+        conditions.append("value = :value")
+    if used == "used":
+        conditions.append("order_id IS NOT NULL")
+    elif used == "unused":
+        conditions.append("order_id IS NULL")
+
+    where_clause = ""
+    if conditions:
+        where_clause = "WHERE " + " AND ".join(conditions)
+
+    page_conditions = list(conditions)
+    # :limit to rozmiar strony + 1 – dodatkowy wiersz mówi, czy jest następna strona
+    page_clause = "LIMIT :limit"
+    if keyset:
+        page_conditions.append("id < :before_id")
+    else:
+        page_clause += " OFFSET :offset"
+
+    page_where = ""
+    if page_conditions:
+        page_where = "WHERE " + " AND ".join(page_conditions)
+
+    count_query = text(f"SELECT COUNT(*) FROM gift_codes {where_clause}")
+    page_query = text(
+        f"""
+        SELECT id, code, value, order_id IS NOT NULL AS used, order_id
+        FROM gift_codes
+        {page_where}
+        ORDER BY id DESC
+        {page_clause}
+        """
+    )
+    return count_query, page_query
+
+
+@functools.lru_cache(maxsize=8)
+def _sql_export_codes(with_value: bool, used: Optional[str]) -> TextClause:
+    """
+    Zapytanie eksportu CSV – te same filtry co lista kodów, całość po id rosnąco.
+    """
+    conditions = []
+    if with_value:
+        conditions.append("value = :value")
+    if used == "used":
+        conditions.append("order_id IS NOT NULL")
+    elif used == "unused":
+        conditions.append("order_id IS NULL")
+
+    where_clause = ""
+    if conditions:
+        where_clause = "WHERE " + " AND ".join(conditions)
+
+    return text(
+        f"""
+        SELECT id, code, value, order_id
+        FROM gift_codes
+        {where_clause}
+        ORDER BY id ASC
+        """
+    )
+
+
 # ------------------------------------------------------------------------------
 # Funkcje pomocnicze
 # ------------------------------------------------------------------------------
@@ -94,26 +448,30 @@ def _extract_giftcard_positions(order: Dict[str, Any]) -> List[Dict[str, Any]]:
     if not products:
         products = order_details.get("basket") or []
 
+    # lokalne aliasy – w pętli po pozycjach koszyka unikamy lookupów globalnych
+    gift_product_id = GIFT_PRODUCT_ID
+    variant_items = _GIFT_VARIANT_ITEMS
+    variant_values = _GIFT_VARIANT_VALUES
+    variant_text_keys = _GIFT_VARIANT_TEXT_KEYS
+    strip_non_digits = _NON_DIGITS_RE.sub
+    append = result.append
+
     for item in products:
+        get = item.get
         try:
-            product_id = int(item.get("productId") or 0)
+            product_id = int(get("productId") or 0)
         except (TypeError, ValueError):
             continue
 
-        if product_id != GIFT_PRODUCT_ID:
+        if product_id != gift_product_id:
             continue
 
-        # Idosell: nominał może być w różnych polach (np. sizePanelName = "200 zł")
-        variant_text_parts = [
-            item.get("productName"),
-            item.get("sizePanelName"),
-            item.get("sizeName"),
-            item.get("versionName"),
-        ]
-        variant_text = " ".join(str(p) for p in variant_text_parts if p).strip()
+        # Idosell: nominał może być w różnych polach (np. sizePanelName = "200 zł");
+        # pierwsza etykieta z GIFT_VARIANTS obecna w którymkolwiek z pól wygrywa
+        variant_text = " ".join(str(p) for p in map(get, variant_text_keys) if p).strip()
 
         matched_value: Optional[int] = None
-        for label, val in GIFT_VARIANTS.items():
+        for label, val in variant_items:
             if label in variant_text:
                 matched_value = val
                 break
@@ -121,21 +479,16 @@ def _extract_giftcard_positions(order: Dict[str, Any]) -> List[Dict[str, Any]]:
         # dodatkowy fallback: jeśli nie ma etykiety "200 zł", spróbuj wyciągnąć liczbę
         # z sizePanelName / sizeName (np. "200 zł", "200zl", "200")
         if matched_value is None:
-            raw = (item.get("sizePanelName") or item.get("sizeName") or "").strip()
-            digits = "".join(ch for ch in str(raw) if ch.isdigit())
-            if digits:
-                try:
-                    maybe = int(digits)
-                    if maybe in set(GIFT_VARIANTS.values()):
-                        matched_value = maybe
-                except ValueError:
-                    pass
+            raw = get("sizePanelName") or get("sizeName") or ""
+            digits = strip_non_digits("", str(raw))
+            if digits and int(digits) in variant_values:
+                matched_value = int(digits)
 
         if matched_value is None:
             continue
 
-        quantity = int(item.get("productQuantity") or item.get("quantity") or 1)
-        result.append({"value": matched_value, "quantity": quantity})
+        quantity = int(get("productQuantity") or get("quantity") or 1)
+        append({"value": matched_value, "quantity": quantity})
 
     return result
 
@@ -146,8 +499,233 @@ def _is_order_paid(order: Dict[str, Any]) -> bool:
     Zakładamy, że w orderDetails.prepaids[*].paymentStatus == 'y' oznacza opłacone.
     """
     order_details = order.get("orderDetails") or {}
-    prepaids = order_details.get("prepaids") or []
-    return any(p.get("paymentStatus") == "y" for p in prepaids)
+    for p in order_details.get("prepaids") or []:
+        if p.get("paymentStatus") == "y":
+            return True
+    return False
+
+
+def _build_order_note(codes: List[Dict[str, Any]]) -> str:
+    """
+    Buduje treść notatki do zamówienia w Idosell dla wszystkich kodów naraz –
+    jedna notatka = jeden PUT do API, niezależnie od liczby kart.
+    """
+    # lista zamiast generatora – str.join i tak by ją najpierw zbudował
+    parts = [f"{c['code']} ({c['value']} zł)" for c in codes]
+    return "Numer(y) karty podarunkowej: " + ", ".join(parts)
+
+
+def _resolve_pending_email(order_serial: str, status: str, message: str) -> None:
+    """
+    Zamienia znacznik email_pending zamówienia na wynik wysyłki (email_sent / email_error).
+    Blokujące (własna sesja) – z kodu async przez asyncio.to_thread.
+    """
+    db = SessionLocal()
+    try:
+        db.execute(
+            _SQL_RESOLVE_PENDING_EMAIL,
+            {"status": status, "message": message[:500], "order_serial": order_serial},
+        )
+        db.commit()
+    except Exception as e:
+        logger.error("Nie udało się zapisać wyniku wysyłki dla zamówienia %s: %s", order_serial, e)
+    finally:
+        db.close()
+
+
+async def _send_giftcard_email_task(
+    client_email: str,
+    assigned_codes: List[Dict[str, Any]],
+    order_id: Any,
+    order_serial: Any,
+) -> None:
+    """
+    Wysyłka maila z kartami uruchamiana w tle przez webhook (BackgroundTasks).
+    Wynik trafia do znacznika email_pending w logach webhooków – odpowiedź
+    do Idosell poszła już wcześniej.
+    """
+    try:
+        await send_giftcard_email_async(
+            to_email=client_email,
+            codes=assigned_codes,
+            order_serial_number=str(order_serial),
+        )
+        logger.info(
+            "Wysłano e-mail z kartą/kartami dla zamówienia %s (%s) na adres %s",
+            order_id,
+            order_serial,
+            client_email,
+        )
+        await asyncio.to_thread(
+            _resolve_pending_email,
+            str(order_serial),
+            "email_sent",
+            f"Wysłano e-mail z kartą/kartami na {client_email}",
+        )
+    except Exception as e:
+        logger.exception("Błąd przy wysyłaniu e-maila z kartą: %s", e)
+        await asyncio.to_thread(
+            _resolve_pending_email,
+            str(order_serial),
+            "email_error",
+            f"Wysyłka e-maila na {client_email} nie powiodła się: {e}",
+        )
+
+
+async def _update_order_note_task(
+    assigned_codes: List[Dict[str, Any]],
+    order_id: Any,
+    order_serial: Any,
+) -> None:
+    """
+    Dopisuje przydzielone kody do notatki zamówienia w Idosell (w tle, po webhooku).
+    Wynik – sukces lub błąd – trafia do logów webhooków.
+    """
+    order_serial_str = str(order_serial).strip()
+
+    note_text = _build_order_note(assigned_codes)
+
+    logger.info(
+        "Idosell: próba aktualizacji notatki zamówienia serial=%s; note='%s'",
+        order_serial_str,
+        note_text,
+    )
+
+    try:
+        await idosell_client.update_order_note_async(order_serial_str, note_text)
+        log_webhook_event(
+            status="idosell_note_updated",
+            message=f"Zaktualizowano notatkę: {note_text}",
+            payload={"note": note_text},
+            order_id=order_id,
+            order_serial=order_serial_str,
+            event_type="idosell_note",
+        )
+    except IdosellApiError as e:
+        logger.error(
+            "Błąd IdosellApiError przy aktualizacji notatki zamówienia %s: %s",
+            order_serial_str,
+            e,
+        )
+        log_webhook_event(
+            status="idosell_note_error",
+            message=f"IdosellApiError: {e}",
+            payload={"note": note_text},
+            order_id=order_id,
+            order_serial=order_serial_str,
+            event_type="idosell_note",
+        )
+    except Exception as e:
+        logger.exception(
+            "Nieoczekiwany błąd przy aktualizacji notatki zamówienia %s: %s",
+            order_serial_str,
+            e,
+        )
+        log_webhook_event(
+            status="idosell_note_error",
+            message=f"Unexpected: {e}",
+            payload={"note": note_text},
+            order_id=order_id,
+            order_serial=order_serial_str,
+            event_type="idosell_note",
+        )
+
+
+async def _deliver_order_task(
+    client_email: Optional[str],
+    assigned_codes: List[Dict[str, Any]],
+    order_id: Any,
+    order_serial: Any,
+) -> None:
+    """
+    Mail z kartami i notatka w Idosell to niezależne wywołania do różnych usług –
+    puszczamy je równolegle (czas = wolniejsze z nich, nie suma).
+    """
+    legs = []
+    tasks = []
+    if client_email:
+        legs.append("e-mail")
+        tasks.append(_send_giftcard_email_task(client_email, assigned_codes, order_id, order_serial))
+    if order_serial and idosell_client:
+        legs.append("notatka Idosell")
+        tasks.append(_update_order_note_task(assigned_codes, order_id, order_serial))
+
+    # oba zadania same logują swoje błędy; return_exceptions – żeby jedno nie przerwało drugiego.
+    # To, co mimo to wyleci, też musi być widoczne w logach panelu.
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for leg, result in zip(legs, results):
+        if isinstance(result, BaseException):
+            logger.error("Błąd zadania w tle (%s) dla zamówienia %s: %s", leg, order_id, result)
+            log_webhook_event(
+                status="error",
+                message=f"Błąd zadania w tle ({leg}): {result}",
+                payload={"codes": assigned_codes},
+                order_id=order_id,
+                order_serial=str(order_serial) if order_serial is not None else None,
+            )
+
+
+# Logi webhooków zapisujemy w tle, paczkami: log_webhook_event tylko wrzuca wiersz
+# do kolejki, a osobny wątek zbiera wszystko, co się nazbierało (do
+# _WEBHOOK_LOG_BATCH_SIZE), i zapisuje jednym INSERT-em (executemany) w jednej
+# transakcji – zamiast sesji + INSERT + commit per zdarzenie.
+_WEBHOOK_LOG_BATCH_SIZE = 200
+_WEBHOOK_LOG_QUEUE: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+_webhook_log_thread: Optional[threading.Thread] = None
+
+
+def _write_webhook_events(rows: List[Dict[str, Any]]) -> None:
+    try:
+        with engine.begin() as conn:
+            conn.execute(WebhookEvent.__table__.insert(), rows)
+    except Exception as e:
+        logger.error("Nie udało się zapisać %s logów webhooka: %s", len(rows), e)
+
+
+def _webhook_log_writer() -> None:
+    """
+    Pętla wątku zapisującego logi; None w kolejce = koniec (po zapisaniu reszty).
+    """
+    while True:
+        row = _WEBHOOK_LOG_QUEUE.get()
+        stop = row is None
+        batch = [] if stop else [row]
+
+        while len(batch) < _WEBHOOK_LOG_BATCH_SIZE:
+            try:
+                row = _WEBHOOK_LOG_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+            if row is None:
+                stop = True
+                break
+            batch.append(row)
+
+        if batch:
+            _write_webhook_events(batch)
+        if stop:
+            return
+
+
+@app.on_event("startup")
+def _start_webhook_log_writer() -> None:
+    global _webhook_log_thread
+    _webhook_log_thread = threading.Thread(
+        target=_webhook_log_writer, name="webhook-log-writer", daemon=True
+    )
+    _webhook_log_thread.start()
+
+
+@app.on_event("shutdown")
+def _stop_webhook_log_writer() -> None:
+    """
+    Dopisuje zaległe logi z kolejki przed zatrzymaniem aplikacji.
+    """
+    global _webhook_log_thread
+    if _webhook_log_thread is not None:
+        _WEBHOOK_LOG_QUEUE.put(None)
+        _webhook_log_thread.join(timeout=10)
+        _webhook_log_thread = None
 
 
 def log_webhook_event(
@@ -160,37 +738,182 @@ def log_webhook_event(
 ) -> None:
     """
     Zapisuje prosty log webhooka w tabeli webhook_events.
+    Nie blokuje – wiersz trafia do kolejki zapisywanej w tle (patrz _webhook_log_writer).
+    payload może być też gotowym JSON-em (bytes, np. surowe body requestu).
     Błędy logowania nie blokują obsługi webhooka.
     """
     try:
-        db = SessionLocal()
+        if not isinstance(payload, (bytes, bytearray)):
+            payload = orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+        # przycinamy bajty przed dekodowaniem – dekodujemy najwyżej 8 KB, a ucięty
+        # w połowie znak wielobajtowy po prostu odpada ("ignore")
+        payload_text = bytes(payload[:8000]).decode("utf-8", "ignore")
+
+        row = {
+            "event_type": event_type,
+            "status": status,
+            "message": (message or "")[:500],
+            "order_id": order_id,
+            "order_serial": str(order_serial) if order_serial is not None else None,
+            "payload": payload_text,
+        }
+    except Exception as e:
+        logger.error("Nie udało się zapisać logu webhooka: %s", e)
+        return
+
+    # bez działającego wątku (np. użycie poza aplikacją) – zapis od razu
+    if _webhook_log_thread is None:
+        _write_webhook_events([row])
+    else:
+        _WEBHOOK_LOG_QUEUE.put(row)
+
+
+def _assign_order_codes(
+    db: Session,
+    order: Dict[str, Any],
+    order_id: Any,
+    order_serial: Any,
+    gift_positions: List[Dict[str, Any]],
+    client_email: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Przydziela kody z puli dla pozycji kart podarunkowych zamówienia.
+    Blokujące (SQLAlchemy) – w webhooku wołane przez run_in_threadpool.
+    Sesję (z Depends(get_db)) zamyka wywołujący.
+
+    Przy nowych kodach i znanym client_email zapisuje w tej samej transakcji
+    znacznik email_pending (patrz _SQL_INSERT_PENDING_EMAIL).
+    """
+    assigned_codes: List[Dict[str, Any]] = []
+    try:
+        order_serial_str = str(order_serial)
+
+        # Ile kart każdego nominału wynika z koszyka (pozycje o tym samym nominale sumujemy)
+        required: Dict[int, int] = {}
+        for pos in gift_positions:
+            required[pos["value"]] = required.get(pos["value"], 0) + pos["quantity"]
+
+        # Ponowione/równoległe dostarczenia tego samego zamówienia (retry Idosell)
+        # czekają tu na siebie do końca transakcji – drugie zobaczy już przypisane
+        # kody i nie przydzieli (ani nie wyśle) ich ponownie
         db.execute(
-            text(
-                """
-                INSERT INTO webhook_events (
-                    event_type, status, message,
-                    order_id, order_serial, payload
+            _SQL_LOCK_ORDER,
+            {"order_id": order_serial_str},
+        )
+
+        # Ile kodów każdego nominału już przypisaliśmy temu zamówieniu? (jedno zapytanie)
+        existing: Dict[int, int] = {
+            row.value: row.cnt
+            for row in db.execute(
+                _SQL_ORDER_CODE_COUNTS,
+                {"order_id": order_serial_str},
+            )
+        }
+
+        # Ile kodów brakuje per nominał (po odjęciu już przypisanych temu zamówieniu)
+        missing: Dict[int, int] = {}
+        for value, quantity in required.items():
+            existing_count = existing.get(value, 0)
+
+            remaining = quantity - existing_count
+
+            if remaining <= 0:
+                logger.info(
+                    "Zamówienie %s (%s): dla nominału %s zł istnieje już %s kodów (wymagane %s) – nie przydzielam nowych.",
+                    order_id,
+                    order_serial,
+                    value,
+                    existing_count,
+                    quantity,
                 )
-                VALUES (:event_type, :status, :message, :order_id, :order_serial, :payload)
-                """
-            ),
-            {
-                "event_type": event_type,
-                "status": status,
-                "message": (message or "")[:500],
-                "order_id": order_id,
-                "order_serial": str(order_serial) if order_serial is not None else None,
-                "payload": json.dumps(payload, ensure_ascii=False)[:8000],
-            },
+                continue
+
+            logger.info(
+                "Zamówienie %s (%s): dla nominału %s zł potrzebujemy jeszcze %s kod(ów) (łącznie %s, już istnieje %s).",
+                order_id,
+                order_serial,
+                value,
+                remaining,
+                quantity,
+                existing_count,
+            )
+            missing[value] = remaining
+
+        # Jedno zapytanie dla wszystkich nominałów naraz
+        code_rows = crud.assign_unused_gift_codes_bulk(
+            db,
+            order_id=order_serial_str,
+            wanted=missing,
         )
+
+        rows_by_value: Dict[int, List[Any]] = {}
+        for r in code_rows:
+            rows_by_value.setdefault(r.value, []).append(r)
+
+        for value, remaining in missing.items():
+            value_rows = rows_by_value.get(value, [])
+            if len(value_rows) < remaining:
+                logger.error(
+                    "Brak dostępnych kodów dla nominału %s (potrzeba %s, dostępne %s) – przerwano proces zamówienia %s",
+                    value,
+                    remaining,
+                    len(value_rows),
+                    order_id,
+                )
+                db.rollback()
+                log_webhook_event(
+                    status="error",
+                    message=f"Brak kodów dla nominału {value}",
+                    payload=order,
+                    order_id=order_id,
+                    order_serial=order_serial_str,
+                )
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Brak kodów dla nominału {value}",
+                )
+
+            assigned_codes.extend(
+                {"code": r.code, "value": r.value} for r in value_rows
+            )
+
+        if assigned_codes and client_email:
+            db.execute(
+                _SQL_INSERT_PENDING_EMAIL,
+                {
+                    "message": f"Oczekuje na wysyłkę e-maila z {len(assigned_codes)} kartą/kartami na {client_email}",
+                    "order_id": str(order_id) if order_id is not None else None,
+                    "order_serial": order_serial_str,
+                },
+            )
+
         db.commit()
+        _invalidate_stats_cache()
+        logger.info(
+            "Przydzielono %s nowych kodów dla zamówienia %s (%s).",
+            len(assigned_codes),
+            order_id,
+            order_serial,
+        )
+
     except Exception as e:
-        logger.exception("Nie udało się zapisać logu webhooka: %s", e)
-    finally:
-        try:
-            db.close()
-        except Exception:
-            pass
+        db.rollback()
+        logger.exception(
+            "Błąd podczas przydzielania kodów dla zamówienia %s (%s): %s",
+            order_id,
+            order_serial,
+            e,
+        )
+        log_webhook_event(
+            status="error",
+            message=f"Błąd przydzielania kodów: {e}",
+            payload=order,
+            order_id=order_id,
+            order_serial=str(order_serial) if order_serial is not None else None,
+        )
+        raise
+
+    return assigned_codes
 
 
 # ------------------------------------------------------------------------------
@@ -199,11 +922,16 @@ def log_webhook_event(
 
 
 @app.post("/webhook/order")
-async def idosell_order_webhook(request: Request):
+async def idosell_order_webhook(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+):
     """
     Główny webhook odbierający zamówienia z Idosell.
     """
-    payload = await request.json()
+    raw_body = await request.body()
+    payload = orjson.loads(raw_body)
 
     order: Optional[Dict[str, Any]] = None
 
@@ -232,9 +960,9 @@ async def idosell_order_webhook(request: Request):
         log_webhook_event(
             status="bad_request",
             message=msg,
-            payload=payload,
+            payload=raw_body,
         )
-        return JSONResponse(
+        return ORJSONResponse(
             {"status": "ignored", "reason": "no_order"},
             status_code=400,
         )
@@ -242,6 +970,31 @@ async def idosell_order_webhook(request: Request):
     order_id = order.get("orderId")
     order_serial = order.get("orderSerialNumber")
 
+    # Do logów: przy płaskim payloadzie (order == całe body) mamy już gotowy JSON –
+    # nie serializujemy zamówienia ponownie
+    order_log_payload: Any = raw_body if order is payload else order
+
+    # 1. Sprawdzamy, czy zamówienie jest opłacone – zanim zaczniemy cokolwiek wyciągać
+    #    z payloadu (retry nieopłaconych zamówień to częsty przypadek)
+    if not _is_order_paid(order):
+        msg = "Zamówienie nie jest opłacone – ignoruję webhook."
+        logger.info(
+            "Zamówienie %s (serial: %s) nie jest opłacone – ignoruję.",
+            order_id,
+            order_serial,
+        )
+        log_webhook_event(
+            status="ignored_unpaid",
+            message=msg,
+            payload=order_log_payload,
+            order_id=order_id,
+            order_serial=str(order_serial) if order_serial is not None else None,
+        )
+        return ORJSONResponse(
+            {"status": "ignored", "reason": "unpaid"},
+            status_code=200,
+        )
+
     # Szukanie maila w kilku możliwych miejscach
     client_email: Optional[str] = None
 
@@ -271,26 +1024,6 @@ async def idosell_order_webhook(request: Request):
         client_email,
     )
 
-    # 1. Sprawdzamy, czy zamówienie jest opłacone
-    if not _is_order_paid(order):
-        msg = "Zamówienie nie jest opłacone – ignoruję webhook."
-        logger.info(
-            "Zamówienie %s (serial: %s) nie jest opłacone – ignoruję.",
-            order_id,
-            order_serial,
-        )
-        log_webhook_event(
-            status="ignored_unpaid",
-            message=msg,
-            payload=order,
-            order_id=order_id,
-            order_serial=str(order_serial) if order_serial is not None else None,
-        )
-        return JSONResponse(
-            {"status": "ignored", "reason": "unpaid"},
-            status_code=200,
-        )
-
     # 2. Wyciągamy pozycje kart podarunkowych
     gift_positions = _extract_giftcard_positions(order)
     if not gift_positions:
@@ -302,192 +1035,68 @@ async def idosell_order_webhook(request: Request):
         log_webhook_event(
             status="ignored_no_giftcards",
             message=msg,
-            payload=order,
+            payload=order_log_payload,
             order_id=order_id,
             order_serial=str(order_serial) if order_serial is not None else None,
         )
-        return JSONResponse(
+        return ORJSONResponse(
             {"status": "ok", "reason": "no_giftcards"},
             status_code=200,
         )
 
-    # 3. Przydzielamy kody z puli
-    db = SessionLocal()
-    assigned_codes: List[Dict[str, Any]] = []
-    try:
-        order_serial_str = str(order_serial)
-
-        for pos in gift_positions:
-            value = pos["value"]
-            quantity = pos["quantity"]  # ile kart tego nominału wynika z koszyka
-
-            # Ile kodów tego nominału już przypisaliśmy temu zamówieniu?
-            existing_count = db.execute(
-                text(
-                    """
-                    SELECT COUNT(*) AS cnt
-                    FROM gift_codes
-                    WHERE order_id = :order_id
-                      AND value = :value
-                    """
-                ),
-                {"order_id": order_serial_str, "value": value},
-            ).scalar_one()
-
-            remaining = quantity - existing_count
-
-            if remaining <= 0:
-                logger.info(
-                    "Zamówienie %s (%s): dla nominału %s zł istnieje już %s kodów (wymagane %s) – nie przydzielam nowych.",
-                    order_id,
-                    order_serial,
-                    value,
-                    existing_count,
-                    quantity,
-                )
-                continue
-
-            logger.info(
-                "Zamówienie %s (%s): dla nominału %s zł potrzebujemy jeszcze %s kod(ów) (łącznie %s, już istnieje %s).",
-                order_id,
-                order_serial,
-                value,
-                remaining,
-                quantity,
-                existing_count,
-            )
-
-            for _ in range(remaining):
-                code_obj = crud.assign_unused_gift_code(
-                    db,
-                    value=value,
-                    order_id=order_serial_str,
-                )
-                if not code_obj:
-                    logger.error(
-                        "Brak dostępnych kodów dla nominału %s – przerwano proces zamówienia %s",
-                        value,
-                        order_id,
-                    )
-                    db.rollback()
-                    log_webhook_event(
-                        status="error",
-                        message=f"Brak kodów dla nominału {value}",
-                        payload=order,
-                        order_id=order_id,
-                        order_serial=order_serial_str,
-                    )
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Brak kodów dla nominału {value}",
-                    )
-
-                assigned_codes.append(
-                    {"code": code_obj.code, "value": code_obj.value}
-                )
+    # 3. Przydzielamy kody z puli (blokujące DB – poza pętlą zdarzeń)
+    assigned_codes = await run_in_threadpool(
+        _assign_order_codes, db, order, order_id, order_serial, gift_positions, client_email
+    )
 
-        db.commit()
+    # Brak NOWO przypisanych kodów = retry webhooka (wszystko już przydzielone) –
+    # nie ma czego renderować, wysyłać ani dopisywać do notatki
+    if not assigned_codes:
         logger.info(
-            "Przydzielono %s nowych kodów dla zamówienia %s (%s).",
-            len(assigned_codes),
+            "Zamówienie %s (%s): brak nowo przypisanych kodów (prawdopodobnie retry) – pomijam e-mail i notatkę.",
             order_id,
             order_serial,
         )
-
-    except Exception as e:
-        db.rollback()
-        logger.exception(
-            "Błąd podczas przydzielania kodów dla zamówienia %s (%s): %s",
-            order_id,
-            order_serial,
-            e,
-        )
         log_webhook_event(
-            status="error",
-            message=f"Błąd przydzielania kodów: {e}",
-            payload=order,
+            status="processed",
+            message="Przydzielono 0 nowych kodów.",
+            payload=order_log_payload,
             order_id=order_id,
             order_serial=str(order_serial) if order_serial is not None else None,
         )
-        raise
-    finally:
-        db.close()
+        return {
+            "status": "processed",
+            "orderId": order_id,
+            "orderSerialNumber": order_serial,
+            "assigned_codes": assigned_codes,
+        }
 
-    # 4. Wysyłka e-maila z kartą/kartami – TYLKO przy pierwszym przydzieleniu
-    #    (jeśli assigned_codes jest puste, to prawdopodobnie retry webhooka)
-    if client_email and assigned_codes:
-        try:
-            send_giftcard_email(
-                to_email=client_email,
-                codes=assigned_codes,
-                order_serial_number=str(order_serial),
-            )
-            logger.info(
-                "Wysłano e-mail z kartą/kartami dla zamówienia %s (%s) na adres %s",
-                order_id,
-                order_serial,
-                client_email,
-            )
-        except Exception as e:
-            logger.exception("Błąd przy wysyłaniu e-maila z kartą: %s", e)
+    # 4. Wysyłka e-maila z kartą/kartami i 5. aktualizacja notatki w Idosell –
+    #    TYLKO przy pierwszym przydzieleniu. Idą w tle, po odesłaniu odpowiedzi
+    #    (Idosell nie czeka na opóźnienie wysyłki, render PDF-ów ani retry API),
+    #    i równolegle względem siebie – patrz _deliver_order_task.
+    background_tasks.add_task(
+        _deliver_order_task,
+        client_email,
+        assigned_codes,
+        order_id,
+        order_serial,
+    )
+
+    if client_email:
+        logger.info(
+            "Zlecono wysyłkę e-maila z kartą/kartami dla zamówienia %s (%s) na adres %s",
+            order_id,
+            order_serial,
+            client_email,
+        )
     else:
         logger.warning(
-            "Brak e-maila klienta lub brak NOWO przypisanych kodów dla zamówienia %s – pomijam wysyłkę maila (prawdopodobnie retry).",
+            "Brak e-maila klienta dla zamówienia %s – pomijam wysyłkę maila.",
             order_id,
         )
 
-    # 5. Aktualizacja notatki zamówienia w Idosell (tylko gdy są nowe kody)
-    if assigned_codes and order_serial and idosell_client:
-        order_serial_str = str(order_serial).strip()
-
-        codes_text = ", ".join(f"{c['code']} ({c['value']} zł)" for c in assigned_codes)
-        note_text = f"Numer(y) karty podarunkowej: {codes_text}"
-
-        logger.info(
-            "Idosell: próba aktualizacji notatki zamówienia serial=%s; note='%s'",
-            order_serial_str,
-            note_text,
-        )
-
-        try:
-            idosell_client.update_order_note(order_serial_str, note_text)
-            log_webhook_event(
-                status="idosell_note_updated",
-                message=f"Zaktualizowano notatkę: {note_text}",
-                payload={"note": note_text},
-                order_id=order_id,
-                order_serial=order_serial_str,
-                event_type="idosell_note",
-            )
-        except IdosellApiError as e:
-            logger.error(
-                "Błąd IdosellApiError przy aktualizacji notatki zamówienia %s: %s",
-                order_serial_str,
-                e,
-            )
-            log_webhook_event(
-                status="idosell_note_error",
-                message=f"IdosellApiError: {e}",
-                payload={"note": note_text},
-                order_id=order_id,
-                order_serial=order_serial_str,
-                event_type="idosell_note",
-            )
-        except Exception as e:
-            logger.exception(
-                "Nieoczekiwany błąd przy aktualizacji notatki zamówienia %s: %s",
-                order_serial_str,
-                e,
-            )
-            log_webhook_event(
-                status="idosell_note_error",
-                message=f"Unexpected: {e}",
-                payload={"note": note_text},
-                order_id=order_id,
-                order_serial=order_serial_str,
-                event_type="idosell_note",
-            )
-    elif assigned_codes and not idosell_client:
+    if not idosell_client:
         logger.warning(
             "Brak skonfigurowanego klienta Idosell – pomijam aktualizację notatki dla zamówienia %s.",
             order_id,
@@ -498,7 +1107,7 @@ async def idosell_order_webhook(request: Request):
     log_webhook_event(
         status="processed",
         message=f"Przydzielono {len(assigned_codes)} nowych kodów.",
-        payload=order,
+        payload=order_log_payload,
         order_id=order_id,
         order_serial=str(order_serial) if order_serial is not None else None,
     )
@@ -516,9 +1125,45 @@ async def idosell_order_webhook(request: Request):
 # ------------------------------------------------------------------------------
 
 
-@app.get("/", response_class=PlainTextResponse)
-def root():
-    return PlainTextResponse("WASSYL Giftcard Webhook – działa.")
+@app.get("/", response_class=PlainTextResponse)
+def root():
+    return PlainTextResponse("WASSYL Giftcard Webhook – działa.")
+
+
+# Wynik sprawdzenia DB trzymamy chwilę – sondy (liveness/readiness) pytają co kilka
+# sekund i nie muszą za każdym razem zajmować połączenia z puli
+_HEALTH_DB_CACHE_TTL = 2.0
+_HEALTH_DB_CACHE: Dict[str, Any] = {"ts": 0.0, "ok": False}
+# Limit czasu SELECT 1 w healthchecku (ms) – żeby sonda nie wisiała przy obciążonej bazie
+_HEALTH_DB_TIMEOUT_MS = 1000
+_SQL_HEALTH_TIMEOUT = text(f"SET LOCAL statement_timeout = {_HEALTH_DB_TIMEOUT_MS}")
+
+# Szablon PDF nie zmienia się w trakcie działania aplikacji
+_PDF_TEMPLATE_FOUND = bool(TEMPLATE_PATH and os.path.exists(TEMPLATE_PATH))
+
+
+def _check_db() -> bool:
+    now = time.monotonic()
+    if now - _HEALTH_DB_CACHE["ts"] < _HEALTH_DB_CACHE_TTL:
+        return _HEALTH_DB_CACHE["ok"]
+
+    db_ok = False
+    db = SessionLocal()
+    try:
+        db.execute(_SQL_HEALTH_TIMEOUT)
+        db.execute(_SQL_SELECT_1)
+        db_ok = True
+    except Exception as e:
+        logger.exception("Healthcheck DB failed: %s", e)
+    finally:
+        try:
+            db.close()
+        except Exception:
+            pass
+
+    _HEALTH_DB_CACHE["ts"] = time.monotonic()
+    _HEALTH_DB_CACHE["ok"] = db_ok
+    return db_ok
 
 
 @app.get("/health")
@@ -529,43 +1174,36 @@ def health_check():
     - konfiguracji Brevo
     - obecności szablonu PDF
     - konfiguracji Idosell
+    - stanu puli połączeń DB
     """
-    db_ok = False
-    brevo_ok = False
-    pdf_ok = False
-    idosell_ok = False
-
-    # DB
-    try:
-        db = SessionLocal()
-        db.execute(text("SELECT 1"))
-        db_ok = True
-    except Exception as e:
-        logger.exception("Healthcheck DB failed: %s", e)
-    finally:
-        try:
-            db.close()
-        except Exception:
-            pass
+    # DB (wynik cache'owany na _HEALTH_DB_CACHE_TTL sekund)
+    db_ok = _check_db()
 
     # Brevo – tylko sprawdzamy czy jest skonfigurowany klucz i nadawca
     brevo_ok = bool((os.getenv('BREVO_API_KEY') or '').strip() and (os.getenv('EMAIL_FROM') or os.getenv('BREVO_FROM_EMAIL') or '').strip())
 
     # PDF template
-    pdf_ok = bool(TEMPLATE_PATH and os.path.exists(TEMPLATE_PATH))
+    pdf_ok = _PDF_TEMPLATE_FOUND
 
     # Idosell
     idosell_ok = idosell_client is not None
 
     status_code = 200 if db_ok and brevo_ok and pdf_ok else 503
 
-    return JSONResponse(
+    return ORJSONResponse(
         {
             "database": db_ok,
             "brevo_configured": brevo_ok,
             "sendgrid_configured": brevo_ok,  # compat: stare monitory mogą tego oczekiwać
             "pdf_template_found": pdf_ok,
             "idosell_configured": idosell_ok,
+            # stan puli połączeń – do monitorowania wyczerpania (checked_out / overflow)
+            "db_pool": {
+                "size": engine.pool.size(),
+                "checked_in": engine.pool.checkedin(),
+                "checked_out": engine.pool.checkedout(),
+                "overflow": engine.pool.overflow(),
+            },
         },
         status_code=status_code,
     )
@@ -605,34 +1243,50 @@ def debug_test_email(to: str = Query(..., description="Adres e-mail odbiorcy tes
     return PlainTextResponse(f"Wysłano testowy e-mail na adres: {to}")
 
 
+# Lista tabel zmienia się tylko przy migracjach – wystarczy odświeżać co minutę
+_TABLES_CACHE_TTL = 60.0
+_TABLES_CACHE: Dict[str, Any] = {"ts": 0.0, "val": []}
+
+
 @app.get("/debug/tables")
 def debug_tables():
     """
-    Zwraca listę tabel w schemacie public.
+    Zwraca listę tabel w schemacie public (cache na _TABLES_CACHE_TTL sekund).
     """
-    db = SessionLocal()
-    try:
-        rows = db.execute(
-            text(
-                """
-                SELECT tablename
-                FROM pg_catalog.pg_tables
-                WHERE schemaname = 'public'
-                ORDER BY tablename
-                """
-            )
-        ).fetchall()
-        tables = [r[0] for r in rows]
-        return {"tables": tables}
-    finally:
-        db.close()
+    now = time.monotonic()
+    if now - _TABLES_CACHE["ts"] > _TABLES_CACHE_TTL:
+        _TABLES_CACHE["val"] = sorted(inspect(engine).get_table_names(schema="public"))
+        _TABLES_CACHE["ts"] = now
+    return {"tables": _TABLES_CACHE["val"]}
+
+
+# Szablon panelu nie ma zmiennych – renderujemy go raz przy starcie i trzymamy
+# gotowe bajty, wersję gzip oraz ETag (zmienia się tylko przy deployu)
+_ADMIN_BYTES = templates.get_template("admin.html").render().encode("utf-8")
+_ADMIN_GZ = gzip.compress(_ADMIN_BYTES, 6)
+_ADMIN_ETAG = '"' + hashlib.md5(_ADMIN_BYTES).hexdigest() + '"'
+
 
 @app.get("/admin", response_class=HTMLResponse)
 def admin_panel(request: Request):
     """
-    Panel administracyjny – renderowany z szablonu Jinja2.
+    Panel administracyjny – prerenderowany szablon Jinja2 z ETag i gzip.
     """
-    return templates.TemplateResponse("admin.html", {"request": request})
+    # no-cache = przeglądarka trzyma kopię, ale zawsze rewaliduje (304 bez treści)
+    headers = {
+        "ETag": _ADMIN_ETAG,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+
+    if request.headers.get("if-none-match") == _ADMIN_ETAG:
+        return Response(status_code=304, headers=headers)
+
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(_ADMIN_GZ, media_type="text/html; charset=utf-8", headers=headers)
+
+    return Response(_ADMIN_BYTES, media_type="text/html; charset=utf-8", headers=headers)
 
 
 # ------------------------------------------------------------------------------
@@ -640,106 +1294,133 @@ def admin_panel(request: Request):
 # ------------------------------------------------------------------------------
 
 
-@app.get("/admin/api/stats")
-def admin_stats():
+def _json_with_etag(request: Request, data: Any) -> Response:
     """
-    Zwraca statystyki kodów (po nominale).
+    Odpowiedź JSON z ETag liczonym z treści – ponowne odświeżenie bez zmian
+    dostaje 304 bez treści. Liczone z bajtów, a nie z licznika zapisów, bo
+    przy kilku workerach każdy widziałby tylko własne zapisy.
     """
-    db = SessionLocal()
-    try:
-        rows = db.execute(
-            text(
-                """
-                SELECT
-                  value,
-                  COUNT(*) AS total,
-                  COUNT(*) FILTER (WHERE order_id IS NULL) AS unused,
-                  COUNT(*) FILTER (WHERE order_id IS NOT NULL) AS used
-                FROM gift_codes
-                GROUP BY value
-                ORDER BY value
-                """
-            )
-        ).fetchall()
+    body = orjson.dumps(data)
+    etag = '"' + hashlib.md5(body).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
 
-        data = [
-            {
-                "value": row.value,
-                "total": row.total,
-                "unused": row.unused,
-                "used": row.used,
-            }
-            for row in rows
-        ]
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    return Response(body, media_type="application/json", headers=headers)
+
+
+# Statystyki odświeża każda otwarta karta panelu – trzymamy wynik chwilę, a każdy
+# zapis zmieniający pulę kodów (dodanie, korekta, przydział) kasuje cache od razu
+_STATS_CACHE_TTL = 5.0
+_STATS_CACHE: Dict[str, Any] = {"ts": 0.0, "val": None}
+
+
+def _invalidate_stats_cache() -> None:
+    _STATS_CACHE["val"] = None
+
+
+def _code_stats(db: Session) -> List[Dict[str, Any]]:
+    """
+    Statystyki kodów po nominale – cache na _STATS_CACHE_TTL sekund.
+    """
+    now = time.monotonic()
+    if _STATS_CACHE["val"] is not None and now - _STATS_CACHE["ts"] < _STATS_CACHE_TTL:
+        return _STATS_CACHE["val"]
+
+    try:
+        # kolumny zapytania = klucze odpowiedzi; orjson nie serializuje RowMapping,
+        # więc dict() – ale bez ręcznego przepisywania pól
+        data = [dict(row) for row in db.execute(_SQL_CODE_STATS).mappings()]
+        _STATS_CACHE["val"] = data
+        _STATS_CACHE["ts"] = now
         return data
     except SQLAlchemyError as e:
         logger.exception("Błąd podczas pobierania statystyk: %s", e)
         raise HTTPException(status_code=500, detail="Błąd bazy danych")
-    finally:
-        db.close()
+
+
+@app.get("/admin/api/stats")
+def admin_stats(request: Request, db: Session = Depends(get_db)):
+    """
+    Zwraca statystyki kodów (po nominale) – cache na _STATS_CACHE_TTL sekund.
+    """
+    data = _code_stats(db)
+    # połączenie wraca do puli przed serializacją i wysyłką odpowiedzi
+    db.close()
+    return _json_with_etag(request, data)
 
 
 @app.get("/admin/api/codes")
 def admin_list_codes(
+    request: Request,
     value: Optional[int] = Query(None, description="Filtr po nominale (np. 100, 200)"),
     used: Optional[str] = Query(
         None, description="Filtr statusu: 'used' lub 'unused'"
     ),
     limit: int = Query(100, ge=1, le=500, description="Maksymalna liczba rekordów"),
+    offset: int = Query(0, ge=0, description="Przesunięcie (stronicowanie)"),
+    before_id: Optional[int] = Query(
+        None, ge=1, description="Kursor: zwróć kody o id mniejszym niż podane"
+    ),
+    db: Session = Depends(get_db),
 ):
     """
-    Zwraca listę ostatnich kodów z możliwością filtrowania.
+    Zwraca stronę ostatnich kodów z możliwością filtrowania.
+
+    Stronicowanie kursorem: before_id = next_before_id z poprzedniej odpowiedzi
+    (zapytanie schodzi po indeksie zamiast przewijać OFFSET wierszy).
+    offset działa dalej dla starszych wywołań.
+
+    Odpowiedź: { "items": [...], "total": <liczba wszystkich pasujących>,
+                 "offset", "limit", "next_before_id" }
     """
-    db = SessionLocal()
     try:
-        conditions = []
-        params: Dict[str, Any] = {"limit": limit}
-
+        # o jeden wiersz więcej niż strona – po nim poznajemy, czy jest następna
+        params: Dict[str, Any] = {"limit": limit + 1}
         if value is not None:
-            conditions.append("value = :value")
             params["value"] = value
+        if before_id is not None:
+            params["before_id"] = before_id
+        else:
+            params["offset"] = offset
 
-        if used is not None:
-            if used == "used":
-                conditions.append("order_id IS NOT NULL")
-            elif used == "unused":
-                conditions.append("order_id IS NULL")
-
-        where_clause = ""
-        if conditions:
-            where_clause = "WHERE " + " AND ".join(conditions)
-
-        query = text(
-            f"""
-            SELECT id, code, value, order_id
-            FROM gift_codes
-            {where_clause}
-            ORDER BY id DESC
-            LIMIT :limit
-            """
+        count_query, page_query = _sql_list_codes(
+            value is not None,
+            used if used in ("used", "unused") else None,
+            before_id is not None,
         )
-        rows = db.execute(query, params).fetchall()
 
-        codes = [
+        # Liczba wszystkich pasujących osobno (index-only po ix_gift_codes_value_order) –
+        # COUNT(*) OVER () w zapytaniu strony wymuszałby przeczytanie całego filtra
+        # i odbierał LIMIT-owi sens
+        total = db.execute(count_query, params).scalar_one()
+        # "used" liczy już baza – wiersz to gotowy element odpowiedzi
+        items = [dict(row) for row in db.execute(page_query, params).mappings()]
+        # wiersze są już w pamięci – połączenie wraca do puli przed budową odpowiedzi
+        db.close()
+
+        next_before_id = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_before_id = items[-1]["id"]
+        return _json_with_etag(
+            request,
             {
-                "id": row.id,
-                "code": row.code,
-                "value": row.value,
-                "used": row.order_id is not None,
-                "order_id": row.order_id,
-            }
-            for row in rows
-        ]
-        return codes
+                "items": items,
+                "total": total,
+                "offset": offset,
+                "limit": limit,
+                "next_before_id": next_before_id,
+            },
+        )
     except SQLAlchemyError as e:
         logger.exception("Błąd podczas pobierania listy kodów: %s", e)
         raise HTTPException(status_code=500, detail="Błąd bazy danych")
-    finally:
-        db.close()
 
 
 @app.post("/admin/api/codes")
-def admin_add_codes(payload: Dict[str, Any]):
+async def admin_add_codes(request: Request, db: Session = Depends(get_db)):
     """
     Dodaje nowe kody do puli dla danego nominału.
 
@@ -754,6 +1435,23 @@ KOD3" }  # string
       - duplikaty kodów w DB są pomijane (ON CONFLICT DO NOTHING)
       - duplikaty w payloadzie są usuwane
       - zwracamy ile realnie dodano i ile pominięto
+
+    Body parsujemy orjsonem (duże listy kodów), zapis do bazy idzie w threadpoolu.
+    """
+    try:
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Nieprawidłowy JSON")
+
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Nieprawidłowy JSON")
+
+    return await run_in_threadpool(_add_codes, db, payload)
+
+
+def _add_codes(db: Session, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Właściwe dodanie kodów dla admin_add_codes (synchronicznie).
     """
     try:
         value = int(payload.get("value"))
@@ -770,42 +1468,20 @@ KOD3" }  # string
     else:
         codes_in = []
 
-    # deduplikacja z zachowaniem kolejności
-    seen = set()
-    codes: List[str] = []
-    for c in codes_in:
-        c = c.strip()
-        if not c:
-            continue
-        if c in seen:
-            continue
-        seen.add(c)
-        codes.append(c)
+    # deduplikacja z zachowaniem kolejności (codes_in jest już oczyszczone z pustych)
+    codes: List[str] = list(dict.fromkeys(codes_in))
 
     if not codes:
         raise HTTPException(status_code=400, detail="Brak kodów do dodania")
 
-    db = SessionLocal()
     try:
-        inserted = 0
-        skipped = 0
-
-        stmt = text(
-            """
-            INSERT INTO gift_codes (code, value, order_id)
-            VALUES (:code, :value, NULL)
-            ON CONFLICT (code) DO NOTHING
-            """
-        )
-
-        for code in codes:
-            res = db.execute(stmt, {"code": code, "value": value})
-            if res.rowcount == 1:
-                inserted += 1
-            else:
-                skipped += 1
+        # Jeden INSERT dla całej listy (unnest tablicy) zamiast zapytania per kod;
+        # RETURNING zwraca tylko faktycznie wstawione wiersze – reszta to duplikaty
+        inserted = len(db.execute(_SQL_INSERT_CODES, {"codes": codes, "value": value}).fetchall())
+        skipped = len(codes) - inserted
 
         db.commit()
+        _invalidate_stats_cache()
         logger.info("Dodano %s nowych kodów dla nominału %s (pominięto duplikaty: %s)", inserted, value, skipped)
 
         return {
@@ -820,12 +1496,10 @@ KOD3" }  # string
         db.rollback()
         logger.exception("Błąd podczas dodawania nowych kodów: %s", e)
         raise HTTPException(status_code=500, detail="Błąd bazy danych")
-    finally:
-        db.close()
 
 
 @app.post("/admin/api/codes/correct-value")
-def admin_correct_codes_value(payload: Dict[str, Any]):
+def admin_correct_codes_value(payload: Dict[str, Any], db: Session = Depends(get_db)):
     """
     Korekta nominału dla wskazanych kodów.
 
@@ -866,21 +1540,9 @@ def admin_correct_codes_value(payload: Dict[str, Any]):
     if not codes:
         raise HTTPException(status_code=400, detail="Brak kodów do korekty")
 
-    db = SessionLocal()
     try:
         # pobierz stan dla podanych kodów
-        # SQLAlchemy expanding param dla IN (...)
-        from sqlalchemy import bindparam
-
-        select_stmt = text(
-            """
-            SELECT code, value, order_id
-            FROM gift_codes
-            WHERE code IN :codes
-            """
-        ).bindparams(bindparam("codes", expanding=True))
-
-        rows = db.execute(select_stmt, {"codes": codes}).fetchall()
+        rows = db.execute(_SQL_CODES_BY_CODE, {"codes": codes}).fetchall()
         found_by_code = {r.code: {"value": r.value, "order_id": r.order_id} for r in rows}
 
         not_found = [c for c in codes if c not in found_by_code]
@@ -888,21 +1550,13 @@ def admin_correct_codes_value(payload: Dict[str, Any]):
 
         eligible = [c for c, info in found_by_code.items() if info["order_id"] is None]
         if eligible:
-            update_stmt = text(
-                """
-                UPDATE gift_codes
-                SET value = :new_value
-                WHERE order_id IS NULL
-                  AND code IN :codes
-                """
-            ).bindparams(bindparam("codes", expanding=True))
-
-            res = db.execute(update_stmt, {"new_value": new_value, "codes": eligible})
+            res = db.execute(_SQL_CORRECT_VALUE, {"new_value": new_value, "codes": eligible})
             updated = int(res.rowcount or 0)
         else:
             updated = 0
 
         db.commit()
+        _invalidate_stats_cache()
 
         return {
             "status": "ok",
@@ -918,8 +1572,6 @@ def admin_correct_codes_value(payload: Dict[str, Any]):
         db.rollback()
         logger.exception("Błąd podczas korekty nominału: %s", e)
         raise HTTPException(status_code=500, detail="Błąd bazy danych")
-    finally:
-        db.close()
 
 
 
@@ -929,7 +1581,7 @@ def admin_correct_codes_value(payload: Dict[str, Any]):
 
 
 @app.post("/admin/api/manual/issue")
-def admin_manual_issue(payload: Dict[str, Any]):
+def admin_manual_issue(payload: Dict[str, Any], db: Session = Depends(get_db)):
     """
     Ręczne przypisanie (lub pobranie istniejącego) kodu karty do zamówienia.
 
@@ -955,49 +1607,40 @@ def admin_manual_issue(payload: Dict[str, Any]):
     email = (payload.get("email") or "").strip()
     order_serial_str = str(order_serial).strip()
 
-    db = SessionLocal()
     try:
-        # 1) Jeśli dla tego numeru zamówienia już jest przypisany kod – zwracamy go (zabezpieczenie przed duplikacją)
-        existing = db.execute(
-            text(
-                """
-                SELECT id, code, value, order_id
-                FROM gift_codes
-                WHERE order_id = :order_id
-                ORDER BY id ASC
-                LIMIT 1
-                """
-            ),
-            {"order_id": order_serial_str},
+        # 1) Ta sama blokada co w webhooku – równoległe wydanie dla tego samego zamówienia
+        #    czeka i widzi już przypisany kod (zabezpieczenie przed duplikacją)
+        db.execute(_SQL_LOCK_ORDER, {"order_id": order_serial_str})
+
+        # 2) Istniejący kod zamówienia albo nowy z puli – jedno zapytanie
+        code_obj = db.execute(
+            _SQL_ISSUE_ORDER_CODE,
+            {"order_id": order_serial_str, "value": value},
         ).mappings().first()
 
-        if existing:
+        if code_obj and code_obj["reused"]:
+            db.rollback()
             return {
                 "status": "ok",
                 "reused": True,
-                "code": existing["code"],
-                "value": int(existing["value"]),
-                "orderSerialNumber": existing["order_id"],
+                "code": code_obj["code"],
+                "value": int(code_obj["value"]),
+                "orderSerialNumber": code_obj["order_id"],
                 "email": email,
             }
 
-        # 2) Przypisanie nowego kodu z puli (używamy tej samej logiki co webhook)
-        code_obj = crud.assign_unused_gift_code(
-            db,
-            value=value,
-            order_id=order_serial_str,
-        )
         if not code_obj:
             raise HTTPException(status_code=409, detail=f"Brak dostępnych kodów dla nominału {value}")
 
         db.commit()
+        _invalidate_stats_cache()
 
-        assigned = {"code": code_obj.code, "value": int(code_obj.value)}
+        assigned = {"code": code_obj["code"], "value": int(code_obj["value"])}
         note_updated = False
 
         # 3) Notatka w Idosell (po ręcznym przypisaniu)
         if idosell_client:
-            note_text = f"Numer(y) karty podarunkowej: {assigned['code']} ({assigned['value']} zł)"
+            note_text = _build_order_note([assigned])
             try:
                 idosell_client.update_order_note(order_serial_str, note_text)
                 note_updated = True
@@ -1044,12 +1687,11 @@ def admin_manual_issue(payload: Dict[str, Any]):
         db.rollback()
         logger.exception("Błąd ręcznego przypisania kodu: %s", e)
         raise HTTPException(status_code=500, detail="Błąd serwera")
-    finally:
-        db.close()
 
 @app.get("/admin/api/manual/order")
 def admin_manual_order(
-    orderSerialNumber: str = Query(..., description="Numer zamówienia (orderSerialNumber)")
+    orderSerialNumber: str = Query(..., description="Numer zamówienia (orderSerialNumber)"),
+    db: Session = Depends(get_db),
 ):
     """
     Zwraca wszystkie kody przypisane do danego zamówienia.
@@ -1059,40 +1701,68 @@ def admin_manual_order(
     if not order_serial_str:
         raise HTTPException(status_code=400, detail="Brak numeru zamówienia")
 
-    db = SessionLocal()
-    try:
-        rows = db.execute(
-            text(
-                """
-                SELECT code, value
-                FROM gift_codes
-                WHERE order_id = :order_id
-                ORDER BY id ASC
-                """
-            ),
-            {"order_id": order_serial_str},
-        ).mappings().all()
+    rows = db.execute(
+        _SQL_ORDER_CODES,
+        {"order_id": order_serial_str},
+    ).mappings().all()
 
-        if not rows:
-            raise HTTPException(status_code=404, detail="Brak przypisanych kart dla tego zamówienia")
+    if not rows:
+        raise HTTPException(status_code=404, detail="Brak przypisanych kart dla tego zamówienia")
+
+    return {
+        "status": "ok",
+        "orderSerialNumber": order_serial_str,
+        "email": "",
+        "codes": [
+            {
+                "code": str(r["code"]),
+                "value": int(r["value"]),
+            }
+            for r in rows
+        ],
+    }
+
+class _ZipChunkSink:
+    """
+    Wyjście dla zipfile bez seek/tell – zipfile pisze wtedy nagłówki z data
+    descriptorami, a my odbieramy gotowe fragmenty archiwum po każdym pliku.
+    """
+
+    def __init__(self) -> None:
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_chunks(files: List[Tuple[str, bytes]]) -> Iterator[bytes]:
+    """
+    Strumieniuje ZIP (nazwa, treść) plik po pliku – bez składania całego
+    archiwum w pamięci.
+    """
+    sink = _ZipChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, content in files:
+            zf.writestr(name, content)
+            yield sink.drain()
+    # centralny katalog zapisuje się przy zamknięciu archiwum
+    yield sink.drain()
 
-        return {
-            "status": "ok",
-            "orderSerialNumber": order_serial_str,
-            "email": "",
-            "codes": [
-                {
-                    "code": str(r["code"]),
-                    "value": int(r["value"]),
-                }
-                for r in rows
-            ],
-        }
-    finally:
-        db.close()
 
 @app.get("/admin/api/manual/pdf")
-def admin_manual_pdf(orderSerialNumber: str = Query(..., description="Numer zamówienia (orderSerialNumber)")):
+def admin_manual_pdf(
+    orderSerialNumber: str = Query(..., description="Numer zamówienia (orderSerialNumber)"),
+    db: Session = Depends(get_db),
+):
     """
     Pobiera PDF dla kodu(ów) przypisanych do danego zamówienia.
     Jeśli jest >1 kod, zwraca ZIP z wieloma PDF-ami.
@@ -1101,55 +1771,108 @@ def admin_manual_pdf(orderSerialNumber: str = Query(..., description="Numer zam
     if not order_serial_str:
         raise HTTPException(status_code=400, detail="Brak numeru zamówienia")
 
-    db = SessionLocal()
-    try:
-        rows = db.execute(
-            text(
-                """
-                SELECT code, value
-                FROM gift_codes
-                WHERE order_id = :order_id
-                ORDER BY id ASC
-                """
-            ),
-            {"order_id": order_serial_str},
-        ).mappings().all()
-
-        if not rows:
-            raise HTTPException(status_code=404, detail="Brak przypisanych kodów dla tego zamówienia")
+    rows = db.execute(
+        _SQL_ORDER_CODES,
+        {"order_id": order_serial_str},
+    ).mappings().all()
 
-        if len(rows) == 1:
-            code_val = rows[0]
-            pdf_bytes = generate_giftcard_pdf(code=str(code_val["code"]), value=int(code_val["value"]))
-            filename = f"giftcard-{order_serial_str}-{code_val['value']}.pdf"
-            return Response(
-                content=pdf_bytes,
-                media_type="application/pdf",
-                headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-            )
+    if not rows:
+        raise HTTPException(status_code=404, detail="Brak przypisanych kodów dla tego zamówienia")
 
-        # wiele kodów => ZIP
-        zbuf = io.BytesIO()
-        with zipfile.ZipFile(zbuf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            for i, cv in enumerate(rows, start=1):
-                pdf_bytes = generate_giftcard_pdf(code=str(cv["code"]), value=int(cv["value"]))
-                zf.writestr(f"giftcard-{order_serial_str}-{i}-{int(cv['value'])}.pdf", pdf_bytes)
-        zbuf.seek(0)
+    if len(rows) == 1:
+        code_val = rows[0]
+        pdf_bytes = generate_giftcard_pdf(code=str(code_val["code"]), value=int(code_val["value"]))
+        filename = f"giftcard-{order_serial_str}-{code_val['value']}.pdf"
         return Response(
-            content=zbuf.getvalue(),
-            media_type="application/zip",
-            headers={"Content-Disposition": f'attachment; filename="giftcards-{order_serial_str}.zip"'},
+            content=pdf_bytes,
+            media_type="application/pdf",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
         )
 
-    finally:
-        db.close()
+    # wiele kodów => ZIP (PDF-y renderowane równolegle w puli procesów)
+    pdfs = generate_giftcard_pdfs([(str(cv["code"]), int(cv["value"])) for cv in rows])
+    files = [
+        (f"giftcard-{order_serial_str}-{i}-{int(cv['value'])}.pdf", pdf_bytes)
+        for i, (cv, pdf_bytes) in enumerate(zip(rows, pdfs), start=1)
+    ]
+    return StreamingResponse(
+        _zip_chunks(files),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="giftcards-{order_serial_str}.zip"'},
+    )
+
+
+
+async def _send_manual_email_task(
+    email: str,
+    order_serial: str,
+    codes: List[Dict[str, Any]],
+    attachments: Optional[List[Tuple[str, bytes]]] = None,
+    subject: str = "",
+    body_text: str = "",
+) -> None:
+    """
+    Ręczna wysyłka maila z panelu, uruchamiana w tle (BackgroundTasks).
+    Bez attachments – produkcyjny mail z kartami (szablon, opóźnienie), z nimi –
+    prosty mail z podanym tematem i treścią.
+
+    Wynik – admin_manual_email albo error – trafia do logów panelu, bo odpowiedź
+    ("queued": true) poszła już wcześniej. Udana wysyłka zamyka też ewentualny
+    email_pending zamówienia z webhooka.
+    """
+    try:
+        if attachments is None:
+            await send_giftcard_email_async(
+                to_email=email,
+                codes=codes,
+                order_serial_number=order_serial,
+            )
+        else:
+            await send_email_async(
+                to_email=email,
+                subject=subject,
+                body_text=body_text,
+                body_html=None,
+                attachments=attachments,
+            )
+    except Exception as e:
+        logger.exception("Błąd ręcznej wysyłki e-mail: %s", e)
+        log_webhook_event(
+            status="error",
+            message=f"Ręczna wysyłka e-mail do {email} nie powiodła się: {e}",
+            payload={"orderSerialNumber": order_serial, "email": email, "attachPdf": attachments is not None},
+            order_id=f"manual:{order_serial}",
+            order_serial=order_serial,
+        )
+        return
+
+    log_webhook_event(
+        status="admin_manual_email",
+        message=f"Ręczna wysyłka e-mail (attachPdf={attachments is not None}) do {email}",
+        payload={"orderSerialNumber": order_serial, "email": email, "codes": codes},
+        order_id=f"manual:{order_serial}",
+        order_serial=order_serial,
+    )
+    await asyncio.to_thread(
+        _resolve_pending_email,
+        order_serial,
+        "email_sent",
+        f"Wysłano ręcznie z panelu na {email}",
+    )
 
 
 @app.post("/admin/api/manual/send-email")
-def admin_manual_send_email(payload: Dict[str, Any]):
+def admin_manual_send_email(
+    payload: Dict[str, Any],
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+):
     """
-    Wysyła e-mail do klienta z kodem(ami) przypisanymi do zamówienia.
+    Zleca wysyłkę e-maila do klienta z kodem(ami) przypisanymi do zamówienia.
     Opcjonalnie załącza PDF.
+
+    Sama wysyłka idzie w tle (jak w webhooku) – odpowiedź ma "queued": true,
+    a wynik (admin_manual_email albo error) pojawia się w logach panelu.
     """
     order_serial = payload.get("orderSerialNumber")
     email = (payload.get("email") or "").strip()
@@ -1162,17 +1885,9 @@ def admin_manual_send_email(payload: Dict[str, Any]):
 
     order_serial_str = str(order_serial).strip()
 
-    db = SessionLocal()
     try:
         rows = db.execute(
-            text(
-                """
-                SELECT code, value
-                FROM gift_codes
-                WHERE order_id = :order_id
-                ORDER BY id ASC
-                """
-            ),
+            _SQL_ORDER_CODES,
             {"order_id": order_serial_str},
         ).mappings().all()
 
@@ -1182,10 +1897,10 @@ def admin_manual_send_email(payload: Dict[str, Any]):
         codes = [{"code": str(r["code"]), "value": int(r["value"])} for r in rows]
 
         if attach_pdf:
-            attachments = []
-            for c in codes:
-                pdf_bytes = generate_giftcard_pdf(code=c["code"], value=c["value"])
-                attachments.append((f"giftcard-{c['value']}.pdf", pdf_bytes))
+            pdfs = generate_giftcard_pdfs([(c["code"], c["value"]) for c in codes])
+            attachments = [
+                (f"giftcard-{c['value']}.pdf", pdf_bytes) for c, pdf_bytes in zip(codes, pdfs)
+            ]
 
             body_text = (
                 "Dzień dobry,\n\n"
@@ -1195,25 +1910,24 @@ def admin_manual_send_email(payload: Dict[str, Any]):
                 + "\n\nPozdrawiamy,\nWASSYL"
             )
 
-            send_email(
-                to_email=email,
+            background_tasks.add_task(
+                _send_manual_email_task,
+                email,
+                order_serial_str,
+                codes,
+                attachments=attachments,
                 subject="WASSYL – Twoja karta podarunkowa",
                 body_text=body_text,
-                body_html=None,
-                attachments=attachments,
             )
         else:
-            # bez PDF – użyj produkcyjnego maila (szablon, formatowanie)
-            send_giftcard_email(
-                to_email=email,
-                codes=codes,
-                order_serial_number=order_serial_str,
-            )
+            # bez PDF – użyj produkcyjnego maila (szablon, formatowanie, opóźnienie)
+            background_tasks.add_task(_send_manual_email_task, email, order_serial_str, codes)
 
+        # wynik samej wysyłki loguje _send_manual_email_task
         try:
             log_webhook_event(
-                status="admin_manual_email",
-                message=f"Ręczna wysyłka e-mail (attachPdf={attach_pdf}) do {email}",
+                status="admin_manual_email_queued",
+                message=f"Zlecono ręczną wysyłkę e-mail (attachPdf={attach_pdf}) do {email}",
                 payload={"orderSerialNumber": order_serial_str, "email": email, "attachPdf": attach_pdf, "codes": codes},
                 order_id=f"manual:{order_serial_str}",
                 order_serial=order_serial_str,
@@ -1221,15 +1935,23 @@ def admin_manual_send_email(payload: Dict[str, Any]):
         except Exception:
             pass
 
-        return {"status": "ok", "sentTo": email, "attachPdf": attach_pdf, "codes": codes}
+        return {
+            "status": "ok",
+            "queued": True,
+            "sentTo": email,
+            "attachPdf": attach_pdf,
+            "codes": codes,
+        }
 
     except HTTPException:
         raise
     except Exception as e:
         logger.exception("Błąd ręcznej wysyłki e-mail: %s", e)
         raise HTTPException(status_code=500, detail="Błąd serwera podczas wysyłki e-mail")
-    finally:
-        db.close()
+
+
+# Ile wierszy eksportu pobieramy z kursora i zamieniamy na CSV naraz
+_EXPORT_CHUNK_SIZE = 1000
 
 
 @app.get("/admin/api/codes/export")
@@ -1242,104 +1964,104 @@ def admin_export_codes(
     """
     Eksport kodów do pliku CSV (id;code;value;order_id).
     Respektuje te same filtry, co /admin/api/codes.
-    """
-    db = SessionLocal()
-    try:
-        conditions = []
-        params: Dict[str, Any] = {}
-
-        if value is not None:
-            conditions.append("value = :value")
-            params["value"] = value
 
-        if used is not None:
-            if used == "used":
-                conditions.append("order_id IS NOT NULL")
-            elif used == "unused":
-                conditions.append("order_id IS NULL")
+    CSV jest strumieniowany: wiersze idą z kursora po stronie serwera
+    (stream_results) paczkami po _EXPORT_CHUNK_SIZE, więc pamięć nie rośnie
+    z rozmiarem tabeli. Sesja żyje do końca strumienia (zamyka ją generator),
+    dlatego nie korzystamy tu z Depends(get_db).
+    """
+    params: Dict[str, Any] = {}
+    if value is not None:
+        params["value"] = value
 
-        where_clause = ""
-        if conditions:
-            where_clause = "WHERE " + " AND ".join(conditions)
+    query = _sql_export_codes(value is not None, used if used in ("used", "unused") else None)
 
-        query = text(
-            f"""
-            SELECT id, code, value, order_id
-            FROM gift_codes
-            {where_clause}
-            ORDER BY id ASC
-            """
-        )
-        rows = db.execute(query, params).fetchall()
+    # Zapytanie wykonujemy jeszcze przed odpowiedzią – błąd bazy to nadal 500,
+    # a nie ucięty w połowie plik
+    db = SessionLocal()
+    try:
+        result = db.execute(query, params, execution_options={"stream_results": True})
+    except SQLAlchemyError as e:
+        db.close()
+        logger.exception("Błąd podczas eksportu kodów: %s", e)
+        raise HTTPException(status_code=500, detail="Błąd bazy danych")
 
+    def csv_chunks():
         output = io.StringIO()
         writer = csv.writer(output, delimiter=";")
-        writer.writerow(["id", "code", "value", "order_id"])
-        for row in rows:
-            writer.writerow([row.id, row.code, row.value, row.order_id])
+        try:
+            writer.writerow(["id", "code", "value", "order_id"])
+            for partition in result.partitions(_EXPORT_CHUNK_SIZE):
+                writer.writerows((row.id, row.code, row.value, row.order_id) for row in partition)
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate(0)
+            # sam nagłówek, gdy brak wierszy
+            if output.tell():
+                yield output.getvalue()
+        except SQLAlchemyError as e:
+            logger.exception("Błąd podczas eksportu kodów (w trakcie strumienia): %s", e)
+            raise
+        finally:
+            result.close()
+            db.close()
 
-        csv_data = output.getvalue()
-        return Response(
-            content=csv_data,
-            media_type="text/csv",
-            headers={
-                "Content-Disposition": 'attachment; filename="gift_codes_export.csv"'
-            },
-        )
-    except SQLAlchemyError as e:
-        logger.exception("Błąd podczas eksportu kodów: %s", e)
-        raise HTTPException(status_code=500, detail="Błąd bazy danych")
-    finally:
-        db.close()
+    return StreamingResponse(
+        csv_chunks(),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": 'attachment; filename="gift_codes_export.csv"'
+        },
+    )
 
 
-@app.get("/admin/api/logs")
-def admin_list_logs(
-    limit: int = Query(50, ge=1, le=200, description="Maksymalna liczba logów"),
-):
+def _recent_logs(db: Session, limit: int) -> List[Dict[str, Any]]:
     """
-    Zwraca ostatnie logi webhooka z tabeli webhook_events.
+    Ostatnie logi webhooka z tabeli webhook_events (najnowsze pierwsze).
     """
-    db = SessionLocal()
     try:
-        rows = db.execute(
-            text(
-                """
-                SELECT id, event_type, status, message,
-                       order_id, order_serial, created_at
-                FROM webhook_events
-                ORDER BY created_at DESC, id DESC
-                LIMIT :limit
-                """
-            ),
-            {"limit": limit},
-        ).fetchall()
-
-        logs = []
-        for row in rows:
-            created_at = None
-            if getattr(row, "created_at", None) is not None:
+        # kolumny zapytania = klucze odpowiedzi; poprawiamy tylko format daty
+        logs = [dict(row) for row in db.execute(_SQL_LIST_LOGS, {"limit": limit}).mappings()]
+        for log in logs:
+            created_at = log["created_at"]
+            if created_at is not None:
                 try:
-                    created_at = row.created_at.isoformat(sep=" ", timespec="seconds")
+                    log["created_at"] = created_at.isoformat(sep=" ", timespec="seconds")
                 except Exception:
-                    created_at = str(row.created_at)
-            logs.append(
-                {
-                    "id": row.id,
-                    "event_type": row.event_type,
-                    "status": row.status,
-                    "message": row.message,
-                    "order_id": row.order_id,
-                    "order_serial": row.order_serial,
-                    "created_at": created_at,
-                }
-            )
+                    log["created_at"] = str(created_at)
         return logs
     except SQLAlchemyError as e:
         logger.exception("Błąd podczas pobierania logów webhooka: %s", e)
         raise HTTPException(status_code=500, detail="Błąd bazy danych")
-    finally:
-        db.close()
+
+
+@app.get("/admin/api/logs")
+def admin_list_logs(
+    limit: int = Query(50, ge=1, le=200, description="Maksymalna liczba logów"),
+    db: Session = Depends(get_db),
+):
+    """
+    Zwraca ostatnie logi webhooka z tabeli webhook_events.
+    """
+    logs = _recent_logs(db, limit)
+    db.close()
+    return logs
+
+
+@app.get("/admin/api/bootstrap")
+def admin_bootstrap(
+    logs_limit: int = Query(50, ge=1, le=200, description="Maksymalna liczba logów"),
+    db: Session = Depends(get_db),
+):
+    """
+    Dane startowe panelu jednym żądaniem, na jednej sesji:
+    { "stats": <jak /admin/api/stats>, "logs": <jak /admin/api/logs> }.
+
+    Lista kodów nie wchodzi w skład – panel pokazuje ją dopiero po wybraniu nominału.
+    """
+    data = {"stats": _code_stats(db), "logs": _recent_logs(db, logs_limit)}
+    db.close()
+    return data
 
 
 
@@ -1,5 +1,11 @@
+import functools
 import io
+import multiprocessing
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
 
 from PyPDF2 import PdfReader, PdfWriter
 from reportlab.pdfgen import canvas
@@ -15,12 +21,27 @@ TEMPLATE_PATH = os.path.join(BASE_DIR, "WASSYL-GIFTCARD2.pdf")
 FONT_PATH = os.path.join(BASE_DIR, "DejaVuSans.ttf")
 FONT_NAME = "DejaVuSans"
 
+# Pula procesów do równoległego renderowania wielu kart (reportlab/PyPDF2 to
+# czysty Python, więc wątki nic by nie dały przez GIL). Tworzona leniwie.
+# Limit per worker uvicorna (nadpisywalny z ENV) – przy kilku workerach procesy się mnożą.
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS") or min(4, os.cpu_count() or 1))
+_PDF_POOL: Optional[ProcessPoolExecutor] = None
 
+# Gotowe karty (code, nominał) -> PDF, w procesie aplikacji – ponowne pobranie
+# lub wysyłka tych samych kart (typowe przy obsłudze klienta) nie renderuje ich
+# od nowa, także gdy renderowała je pula procesów. Karta to ~250 KB.
+PDF_CACHE_SIZE = int(os.getenv("PDF_CACHE_SIZE") or 64)
+_PDF_CACHE: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+_PDF_CACHE_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
 def _get_font_names() -> tuple[str, str]:
     """
     Zwraca nazwy czcionek do użycia (value_font, code_font).
     Jeśli jest DejaVuSans.ttf – rejestrujemy ją i używamy.
     Jeśli nie – wracamy do Helvetica (ale zamieniamy ł -> l).
+    Wynik (i rejestracja TTF) liczony raz na proces.
     """
     if os.path.exists(FONT_PATH):
         if FONT_NAME not in pdfmetrics.getRegisteredFontNames():
@@ -31,36 +52,58 @@ def _get_font_names() -> tuple[str, str]:
     return "Helvetica", "Helvetica"
 
 
-def generate_giftcard_pdf(code: str, value: int | float | str) -> bytes:
+@functools.lru_cache(maxsize=1)
+def _template_bytes() -> bytes:
     """
-    Generuje pojedynczą kartę podarunkową jako PDF.
-
-    value może być int/float/str – próba zrzutowania na int.
+    Zawartość szablonu karty – czytana z dysku raz na proces, potem z pamięci.
     """
-    # 0. Walidacja value
-    try:
-        numeric_value = int(round(float(value)))
-    except (TypeError, ValueError):
-        raise ValueError(f"Nieprawidłowa wartość nominalna karty: {value!r}")
-
-    # 1. Sprawdzenie obecności szablonu
     if not os.path.exists(TEMPLATE_PATH):
         raise FileNotFoundError(
             f"Brak pliku szablonu PDF: {TEMPLATE_PATH}. "
             "Upewnij się, że WASSYL-GIFTCARD2.pdf jest w katalogu aplikacji."
         )
 
-    # 2. Wczytanie szablonu
     with open(TEMPLATE_PATH, "rb") as f:
-        template_bytes = f.read()
+        return f.read()
+
+
+def _numeric_value(value: int | float | str) -> int:
+    try:
+        return int(round(float(value)))
+    except (TypeError, ValueError):
+        raise ValueError(f"Nieprawidłowa wartość nominalna karty: {value!r}")
+
+
+def _cache_get(key: Tuple[str, int]) -> Optional[bytes]:
+    with _PDF_CACHE_LOCK:
+        pdf = _PDF_CACHE.get(key)
+        if pdf is not None:
+            _PDF_CACHE.move_to_end(key)
+        return pdf
+
+
+def _cache_put(key: Tuple[str, int], pdf: bytes) -> None:
+    with _PDF_CACHE_LOCK:
+        _PDF_CACHE[key] = pdf
+        _PDF_CACHE.move_to_end(key)
+        while len(_PDF_CACHE) > PDF_CACHE_SIZE:
+            _PDF_CACHE.popitem(last=False)
 
-    template_reader = PdfReader(io.BytesIO(template_bytes))
+
+def _render_card(code: str, numeric_value: int) -> bytes:
+    """
+    Renderuje jedną kartę: szablon + jedna nakładka z nominałem i kodem.
+    Funkcja modułowa – wywoływana też w puli procesów.
+    """
+    # 1. Szablon (z pamięci – patrz _template_bytes); merge_page modyfikuje
+    # stronę, więc każda karta parsuje własną kopię
+    template_reader = PdfReader(io.BytesIO(_template_bytes()))
     base_page = template_reader.pages[0]
 
     width = float(base_page.mediabox.width)
     height = float(base_page.mediabox.height)
 
-    # 3. Przygotowanie nakładki
+    # 2. Przygotowanie nakładki
     packet = io.BytesIO()
     c = canvas.Canvas(packet, pagesize=(width, height))
 
@@ -91,7 +134,7 @@ def generate_giftcard_pdf(code: str, value: int | float | str) -> bytes:
 
     c.save()
 
-    # 4. Połączenie nakładki z szablonem
+    # 3. Połączenie nakładki z szablonem
     packet.seek(0)
     overlay_reader = PdfReader(packet)
     overlay_page = overlay_reader.pages[0]
@@ -104,3 +147,73 @@ def generate_giftcard_pdf(code: str, value: int | float | str) -> bytes:
     output_stream = io.BytesIO()
     writer.write(output_stream)
     return output_stream.getvalue()
+
+
+def generate_giftcard_pdf(code: str, value: int | float | str) -> bytes:
+    """
+    Generuje pojedynczą kartę podarunkową jako PDF.
+
+    value może być int/float/str – próba zrzutowania na int.
+    Wynik jest cache'owany per (code, value) – ponowne pobranie tej samej karty
+    (PDF z panelu, ponowna wysyłka maila) nie renderuje jej od nowa.
+    """
+    key = (str(code), _numeric_value(value))
+    pdf = _cache_get(key)
+    if pdf is None:
+        pdf = _render_card(*key)
+        _cache_put(key, pdf)
+    return pdf
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _PDF_POOL
+    if _PDF_POOL is None:
+        # spawn, nie fork: proces aplikacji ma wątki (pula, zapis logów) i otwarte
+        # gniazda DB/HTTP – fork mógłby odziedziczyć zajęte locki albo te gniazda
+        _PDF_POOL = ProcessPoolExecutor(
+            max_workers=PDF_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _PDF_POOL
+
+
+def generate_giftcard_pdfs(cards: Sequence[Tuple[str, int | float | str]]) -> List[bytes]:
+    """
+    Generuje PDF-y dla wielu kart naraz – (code, value) -> bytes, w tej samej kolejności.
+    Karty z cache idą od razu; przy więcej niż jednej brakującej renderowanie idzie
+    równolegle w puli procesów, a wyniki trafiają do cache tego procesu.
+    """
+    keys = [(str(code), _numeric_value(value)) for code, value in cards]
+
+    found: Dict[Tuple[str, int], bytes] = {}
+    missing: List[Tuple[str, int]] = []
+    for key in keys:
+        if key in found or key in missing:
+            continue
+        pdf = _cache_get(key)
+        if pdf is None:
+            missing.append(key)
+        else:
+            found[key] = pdf
+
+    if len(missing) == 1:
+        found[missing[0]] = _render_card(*missing[0])
+        _cache_put(missing[0], found[missing[0]])
+    elif missing:
+        pool = _get_pdf_pool()
+        futures = [pool.submit(_render_card, code, value) for code, value in missing]
+        for key, future in zip(missing, futures):
+            found[key] = future.result()
+            _cache_put(key, found[key])
+
+    return [found[key] for key in keys]
+
+
+def shutdown_pdf_pool() -> None:
+    """
+    Zamyka pulę procesów PDF (wywoływane przy zamykaniu aplikacji).
+    """
+    global _PDF_POOL
+    if _PDF_POOL is not None:
+        _PDF_POOL.shutdown(wait=False, cancel_futures=True)
+        _PDF_POOL = None
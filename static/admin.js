@@ -20,32 +20,112 @@ function escapeHtml(value) {
     .replaceAll("'", "&#039;");
 }
 
+// Jeden formatter na całą stronę – nominały w tabelach i kartach ("100 zł")
+const PLN = new Intl.NumberFormat("pl-PL", {
+  style: "currency",
+  currency: "PLN",
+  minimumFractionDigits: 0,
+  maximumFractionDigits: 0,
+});
+
+function formatPln(value) {
+  const n = Number(value);
+  return Number.isFinite(n) ? PLN.format(n) : escapeHtml(value) + " zł";
+}
+
+// Wyrażenia do dzielenia/liczenia linii – tworzone raz
+const NL_RE = /\r?\n/;
+const NON_EMPTY_LINE_RE = /^.*\S.*$/gm;
+
 function normalizeLines(text) {
   return (text || "")
-    .split(/\r?\n/)
+    .split(NL_RE)
     .map((l) => l.trim())
     .filter((l) => l.length > 0);
 }
 
+// Powyżej tej długości pola (ok. 10 tys. kodów) parsowanie i JSON.stringify idą
+// do Web Workera, żeby wklejka rzędu setek tysięcy linii nie blokowała strony
+const CODES_WORKER_MIN_CHARS = 200000;
+
+const CODES_WORKER_SOURCE = `
+onmessage = (e) => {
+  const { text, extra } = e.data;
+  const codes = [];
+  for (const line of text.split(/\\r?\\n/)) {
+    const t = line.trim();
+    if (t) codes.push(t);
+  }
+  postMessage({ count: codes.length, body: JSON.stringify({ ...extra, codes }) });
+};
+`;
+
+let codesWorkerUrl = null;
+
+// Zwraca { count, body } – body to gotowy JSON { ...extra, codes } do fetch()
+function buildCodesBody(text, extra) {
+  text = text || "";
+  if (text.length < CODES_WORKER_MIN_CHARS || typeof Worker === "undefined") {
+    const codes = normalizeLines(text);
+    return Promise.resolve({ count: codes.length, body: JSON.stringify({ ...extra, codes }) });
+  }
+
+  if (!codesWorkerUrl) {
+    codesWorkerUrl = URL.createObjectURL(
+      new Blob([CODES_WORKER_SOURCE], { type: "application/javascript" })
+    );
+  }
+
+  return new Promise((resolve, reject) => {
+    const worker = new Worker(codesWorkerUrl);
+    worker.onmessage = (e) => {
+      worker.terminate();
+      resolve(e.data);
+    };
+    worker.onerror = (e) => {
+      worker.terminate();
+      reject(new Error(e.message || "Błąd przetwarzania kodów"));
+    };
+    worker.postMessage({ text, extra });
+  });
+}
+
+// Liczy niepuste linie jednym przebiegiem regexa – bez budowania tablic jak normalizeLines
+function countLines(text) {
+  return ((text || "").match(NON_EMPTY_LINE_RE) || []).length;
+}
+
 function updateSummary(textarea, summaryNode) {
-  const lines = normalizeLines(textarea.value);
-  summaryNode.innerHTML = `Liczba kodów: <strong>${lines.length}</strong>`;
+  summaryNode.innerHTML = `Liczba kodów: <strong>${countLines(textarea.value)}</strong>`;
+}
+
+// Licznik przeliczamy dopiero po chwili bez pisania – przy wklejonych dziesiątkach
+// tysięcy kodów każde naciśnięcie klawisza nie skanuje całego pola
+function debouncedSummary(textarea, summaryNode, delayMs = 120) {
+  let timer = null;
+  return () => {
+    clearTimeout(timer);
+    timer = setTimeout(() => updateSummary(textarea, summaryNode), delayMs);
+  };
 }
 
 async function saveCodes() {
   const value = parseInt(document.getElementById("nominal-select").value, 10);
-  const codes = normalizeLines(addTextarea.value);
-
-  if (!codes.length) {
-    alert("Wpisz przynajmniej jeden kod.");
-    return;
-  }
+  const button = document.getElementById("btn-save-codes");
 
+  button.disabled = true;
   try {
+    const { count, body } = await buildCodesBody(addTextarea.value, { value });
+
+    if (!count) {
+      alert("Wpisz przynajmniej jeden kod.");
+      return;
+    }
+
     const res = await fetch("/admin/api/codes", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ value, codes }),
+      body,
     });
 
     const data = await res.json();
@@ -58,6 +138,8 @@ async function saveCodes() {
     maybeLoadCodes();
   } catch (e) {
     alert(e.message || "Błąd komunikacji z serwerem.");
+  } finally {
+    button.disabled = false;
   }
 }
 
@@ -95,6 +177,29 @@ async function correctValue() {
   }
 }
 
+function renderStats(data) {
+  const container = document.getElementById("stats-container");
+
+  if (!Array.isArray(data) || !data.length) {
+    container.innerHTML = '<div class="muted">Brak danych statystycznych.</div>';
+    return;
+  }
+
+  // etykiety ("Łącznie", "Nieużyte", "Użyte") dokłada CSS (::before)
+  container.innerHTML = data
+    .map(
+      (row) => `
+        <div class="stat-card">
+          <h3>${formatPln(row.value)}</h3>
+          <div class="stat-row total"><strong>${row.total}</strong></div>
+          <div class="stat-row unused"><strong>${row.unused}</strong></div>
+          <div class="stat-row used"><strong>${row.used}</strong></div>
+        </div>
+      `
+    )
+    .join("");
+}
+
 async function loadStats() {
   const container = document.getElementById("stats-container");
   container.innerHTML = '<div class="muted">Ładowanie statystyk...</div>';
@@ -105,32 +210,25 @@ async function loadStats() {
 
     if (!res.ok) throw new Error(data.detail || "Błąd statystyk");
 
-    if (!Array.isArray(data) || !data.length) {
-      container.innerHTML = '<div class="muted">Brak danych statystycznych.</div>';
-      return;
-    }
-
-    container.innerHTML = "";
-    data.forEach((row) => {
-      const card = document.createElement("div");
-      card.className = "stat-card";
-      card.innerHTML = `
-        <h3>${escapeHtml(row.value)} zł</h3>
-        <div class="stat-row">Łącznie: <strong>${row.total}</strong></div>
-        <div class="stat-row">Nieużyte: <strong>${row.unused}</strong></div>
-        <div class="stat-row">Użyte: <strong>${row.used}</strong></div>
-      `;
-      container.appendChild(card);
-    });
+    renderStats(data);
   } catch (e) {
     container.innerHTML = '<div class="muted">Nie udało się pobrać statystyk.</div>';
   }
 }
 
+// Stronicowanie kursorem: codesCursor = before_id bieżącej strony,
+// codesOffset – tylko do opisu "Rekordy x–y", codesHistory – poprzednie strony.
+let codesCursor = null;
+let codesOffset = 0;
+let codesHistory = [];
+let codesNextCursor = null;
+let codesPageSize = 0;
+
 async function loadCodes() {
   const tbody = document.getElementById("codes-tbody");
   const emptyState = document.getElementById("codes-empty-state");
   const tableWrap = document.getElementById("codes-table-wrap");
+  const pager = document.getElementById("codes-pager");
 
   const filterValue = document.getElementById("filter-value").value;
   const filterUsed = document.getElementById("filter-used").value;
@@ -138,6 +236,7 @@ async function loadCodes() {
 
   if (!filterValue) {
     tableWrap.classList.add("hidden");
+    pager.classList.add("hidden");
     emptyState.classList.remove("hidden");
     emptyState.textContent = "Wybierz nominał, aby zobaczyć listę kodów.";
     return;
@@ -152,6 +251,7 @@ async function loadCodes() {
   params.set("value", filterValue);
   if (filterUsed) params.set("used", filterUsed);
   if (filterLimit) params.set("limit", filterLimit);
+  if (codesCursor) params.set("before_id", String(codesCursor));
 
   try {
     const res = await fetch("/admin/api/codes?" + params.toString());
@@ -159,28 +259,77 @@ async function loadCodes() {
 
     if (!res.ok) throw new Error(data.detail || "Błąd pobierania");
 
-    if (!Array.isArray(data) || !data.length) {
+    renderCodesPager(data);
+
+    if (!data || !Array.isArray(data.items) || !data.items.length) {
       tbody.innerHTML = '<tr><td colspan="5" class="muted center padded">Brak rekordów dla wybranego filtra.</td></tr>';
       return;
     }
 
-    tbody.innerHTML = "";
-    data.forEach((row) => {
-      const tr = document.createElement("tr");
-      tr.innerHTML = `
-        <td>${row.id}</td>
-        <td><strong>${escapeHtml(row.code)}</strong></td>
-        <td>${row.value} zł</td>
-        <td>${row.used ? '<span class="pill ok">Użyty</span>' : '<span class="pill">Nieużyty</span>'}</td>
-        <td>${row.order_id ? escapeHtml(String(row.order_id)) : "—"}</td>
-      `;
-      tbody.appendChild(tr);
-    });
+    // cała strona jednym przypisaniem innerHTML – jeden reflow zamiast jednego na wiersz
+    tbody.innerHTML = data.items
+      .map(
+        (row) => `
+          <tr>
+            <td>${row.id}</td>
+            <td><strong>${escapeHtml(row.code)}</strong></td>
+            <td>${formatPln(row.value)}</td>
+            <td>${row.used ? '<span class="pill ok">Użyty</span>' : '<span class="pill">Nieużyty</span>'}</td>
+            <td>${row.order_id ? escapeHtml(String(row.order_id)) : "—"}</td>
+          </tr>
+        `
+      )
+      .join("");
   } catch (e) {
     tbody.innerHTML = '<tr><td colspan="5" class="muted center padded">Nie udało się pobrać danych.</td></tr>';
   }
 }
 
+function renderCodesPager(data) {
+  const pager = document.getElementById("codes-pager");
+  const total = (data && data.total) || 0;
+  const limit = (data && data.limit) || 1;
+  const offset = codesOffset;
+
+  codesNextCursor = (data && data.next_before_id) || null;
+  codesPageSize = (data && Array.isArray(data.items) && data.items.length) || 0;
+
+  if (!total) {
+    pager.classList.add("hidden");
+    return;
+  }
+
+  pager.classList.remove("hidden");
+  const from = Math.min(offset + 1, total);
+  const to = Math.min(offset + limit, total);
+  document.getElementById("codes-pager-info").innerHTML =
+    `Rekordy <strong>${from}–${to}</strong> z <strong>${total}</strong>`;
+  document.getElementById("btn-codes-prev").disabled = !codesHistory.length;
+  document.getElementById("btn-codes-next").disabled = !codesNextCursor;
+}
+
+function codesPage(direction) {
+  if (direction > 0) {
+    if (!codesNextCursor) return;
+    codesHistory.push({ cursor: codesCursor, offset: codesOffset });
+    codesCursor = codesNextCursor;
+    codesOffset += codesPageSize;
+  } else {
+    const prev = codesHistory.pop();
+    if (!prev) return;
+    codesCursor = prev.cursor;
+    codesOffset = prev.offset;
+  }
+  loadCodes();
+}
+
+function applyCodeFilters() {
+  codesCursor = null;
+  codesOffset = 0;
+  codesHistory = [];
+  loadCodes();
+}
+
 function maybeLoadCodes() {
   const value = document.getElementById("filter-value").value;
   if (value) loadCodes();
@@ -202,6 +351,34 @@ function exportCsv() {
   window.open("/admin/api/codes/export?" + params.toString(), "_blank");
 }
 
+function renderLogs(data) {
+  const tbody = document.getElementById("logs-tbody");
+
+  if (!Array.isArray(data) || !data.length) {
+    tbody.innerHTML = '<tr><td colspan="5" class="muted center padded">Brak logów.</td></tr>';
+    return;
+  }
+
+  tbody.innerHTML = data
+    .map((row) => {
+      const status = row.status || "";
+      const statusClass =
+        status === "processed" || status === "email_sent" ? "ok" :
+        status === "error" || status.endsWith("_error") ? "err" : "";
+
+      return `
+        <tr>
+          <td>${escapeHtml(row.created_at || "—")}</td>
+          <td><span class="pill ${statusClass}">${escapeHtml(row.status || "—")}</span></td>
+          <td>${escapeHtml(row.order_id || "—")}</td>
+          <td>${escapeHtml(row.order_serial || "—")}</td>
+          <td>${escapeHtml(row.message || "—")}</td>
+        </tr>
+      `;
+    })
+    .join("");
+}
+
 async function loadLogs() {
   const tbody = document.getElementById("logs-tbody");
   tbody.innerHTML = '<tr><td colspan="5" class="muted center padded">Ładowanie logów...</td></tr>';
@@ -212,32 +389,29 @@ async function loadLogs() {
 
     if (!res.ok) throw new Error(data.detail || "Błąd logów");
 
-    if (!Array.isArray(data) || !data.length) {
-      tbody.innerHTML = '<tr><td colspan="5" class="muted center padded">Brak logów.</td></tr>';
-      return;
-    }
-
-    tbody.innerHTML = "";
-    data.forEach((row) => {
-      const statusClass =
-        row.status === "processed" ? "ok" :
-        row.status === "error" ? "err" : "";
-
-      const tr = document.createElement("tr");
-      tr.innerHTML = `
-        <td>${escapeHtml(row.created_at || "—")}</td>
-        <td><span class="pill ${statusClass}">${escapeHtml(row.status || "—")}</span></td>
-        <td>${escapeHtml(row.order_id || "—")}</td>
-        <td>${escapeHtml(row.order_serial || "—")}</td>
-        <td>${escapeHtml(row.message || "—")}</td>
-      `;
-      tbody.appendChild(tr);
-    });
+    renderLogs(data);
   } catch (e) {
     tbody.innerHTML = '<tr><td colspan="5" class="muted center padded">Nie udało się pobrać logów.</td></tr>';
   }
 }
 
+// Start panelu: statystyki i logi jednym żądaniem (/admin/api/bootstrap)
+async function loadBootstrap() {
+  try {
+    const res = await fetch("/admin/api/bootstrap");
+    const data = await res.json();
+
+    if (!res.ok) throw new Error(data.detail || "Błąd pobierania");
+
+    renderStats(data.stats);
+    renderLogs(data.logs);
+  } catch (e) {
+    // np. błąd jednej z części – każda sekcja pobiera się wtedy osobno
+    loadStats();
+    loadLogs();
+  }
+}
+
 function renderManualPreview(data) {
   if (!data || !Array.isArray(data.codes) || !data.codes.length) {
     manualPreview.classList.add("hidden");
@@ -251,7 +425,7 @@ function renderManualPreview(data) {
       (item) => `
         <div class="preview-item">
           <div><strong>Kod:</strong> ${escapeHtml(item.code)}</div>
-          <div><strong>Nominał:</strong> ${escapeHtml(item.value)} zł</div>
+          <div><strong>Nominał:</strong> ${formatPln(item.value)}</div>
         </div>
       `
     )
@@ -330,7 +504,7 @@ async function manualIssue() {
 
     out.innerHTML =
       '<span class="pill ok">OK</span> ' +
-      `Kod: <strong>${escapeHtml(data.code)}</strong> (${data.value} zł) • ` +
+      `Kod: <strong>${escapeHtml(data.code)}</strong> (${formatPln(data.value)}) • ` +
       `Zamówienie: <strong>${escapeHtml(data.orderSerialNumber)}</strong> • ` +
       `Reuse: <strong>${reused}</strong>.${note}`;
 
@@ -372,8 +546,9 @@ async function manualSendEmail() {
     const data = await res.json();
     if (!res.ok) throw new Error(data.detail || "Błąd wysyłki");
 
+    // wysyłka idzie w tle – ewentualny błąd pojawi się w logach poniżej
     manualResult.innerHTML =
-      '<span class="pill ok">Wysłano</span> ' +
+      `<span class="pill ok">${data.queued ? "Zlecono" : "Wysłano"}</span> ` +
       `Na: <strong>${escapeHtml(data.sentTo)}</strong> • PDF: <strong>${data.attachPdf ? "tak" : "nie"}</strong>.`;
   } catch (e) {
     manualResult.innerHTML = '<span class="pill err">Błąd</span> ' + escapeHtml(e.message || String(e));
@@ -381,15 +556,17 @@ async function manualSendEmail() {
 }
 
 document.addEventListener("DOMContentLoaded", () => {
-  addTextarea.addEventListener("input", () => updateSummary(addTextarea, addSummary));
-  correctTextarea.addEventListener("input", () => updateSummary(correctTextarea, correctSummary));
+  addTextarea.addEventListener("input", debouncedSummary(addTextarea, addSummary));
+  correctTextarea.addEventListener("input", debouncedSummary(correctTextarea, correctSummary));
 
   document.getElementById("btn-save-codes").addEventListener("click", saveCodes);
   document.getElementById("btn-correct-value").addEventListener("click", correctValue);
 
   document.getElementById("btn-refresh-stats").addEventListener("click", loadStats);
   document.getElementById("btn-refresh-codes").addEventListener("click", loadCodes);
-  document.getElementById("btn-apply-filters").addEventListener("click", loadCodes);
+  document.getElementById("btn-apply-filters").addEventListener("click", applyCodeFilters);
+  document.getElementById("btn-codes-prev").addEventListener("click", () => codesPage(-1));
+  document.getElementById("btn-codes-next").addEventListener("click", () => codesPage(1));
   document.getElementById("btn-export-csv").addEventListener("click", exportCsv);
 
   document.getElementById("btn-manual-load").addEventListener("click", manualLoad);
@@ -401,6 +578,5 @@ document.addEventListener("DOMContentLoaded", () => {
 
   updateSummary(addTextarea, addSummary);
   updateSummary(correctTextarea, correctSummary);
-  loadStats();
-  loadLogs();
+  loadBootstrap();
 });